@@ -0,0 +1,253 @@
+"""
+Servidor local que imita o pedaço da Bot API do Telegram que o main.py usa.
+Responde com objetos mínimos válidos para o aiogram e conta as chamadas por
+método, para o benchmark rodar sem rede.
+
+Latência, 429 e erros 5xx são injetáveis (com seed, para ser reproduzível).
+Rodando sozinho, o bot aponta para ele com TELEGRAM_API_URL:
+
+    python -m bench.fake_telegram --port 8081 --latency-ms 40 --rate-429 0.02
+    TELEGRAM_API_URL=http://127.0.0.1:8081 uvicorn main:app
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "VIP Bench", "username": "vip_bench_bot"}
+
+
+class FakeTelegram:
+    """
+    latency_ms/jitter_ms: atraso de cada resposta (uniforme em latency ± jitter).
+    rate_429: fração das chamadas respondidas com 429 + retry_after.
+    fail_rate: fração respondida com 500 (TelegramServerError no aiogram).
+    fault_methods: limita 429/500 a esses métodos (padrão: todos).
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+        fail_rate: float = 0.0,
+        fault_methods: Optional[set] = None,
+        seed: Optional[int] = None,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.fail_rate = fail_rate
+        self.fault_methods = fault_methods
+        self._random = random.Random(seed)
+        self.calls = Counter()
+        self.faults = Counter()
+        self.webhook = {"url": "", "allowed_updates": []}
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.url = ""
+
+        self.methods = {
+            "getMe": self.get_me,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "answerCallbackQuery": self.ok,
+            "createChatInviteLink": self.create_chat_invite_link,
+            "revokeChatInviteLink": self.revoke_chat_invite_link,
+            "banChatMember": self.ok,
+            "unbanChatMember": self.ok,
+            "setWebhook": self.set_webhook,
+            "deleteWebhook": self.delete_webhook,
+            "getWebhookInfo": self.get_webhook_info,
+        }
+        self.async_methods = {
+            "getUpdates": self.get_updates,
+        }
+
+    # ---- métodos da API (params já vêm como str do form) ----
+    def ok(self, params):
+        return True
+
+    def get_me(self, params):
+        return BOT_USER
+
+    def _message(self, params):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def send_message(self, params):
+        return self._message(params)
+
+    def edit_message_text(self, params):
+        if "inline_message_id" in params:
+            return True
+        return self._message(params)
+
+    def _invite(self, link: str, params, revoked: bool = False):
+        invite = {
+            "invite_link": link,
+            "creator": BOT_USER,
+            "creates_join_request": False,
+            "is_primary": False,
+            "is_revoked": revoked,
+        }
+        if params.get("expire_date"):
+            invite["expire_date"] = int(params["expire_date"])
+        if params.get("member_limit"):
+            invite["member_limit"] = int(params["member_limit"])
+        return invite
+
+    def create_chat_invite_link(self, params):
+        return self._invite(f"https://t.me/+bench{next(self._ids)}", params)
+
+    def revoke_chat_invite_link(self, params):
+        return self._invite(params["invite_link"], params, revoked=True)
+
+    def set_webhook(self, params):
+        self.webhook = {"url": params.get("url", ""), "allowed_updates": params.get("allowed_updates")}
+        return True
+
+    def delete_webhook(self, params):
+        self.webhook = {"url": "", "allowed_updates": []}
+        return True
+
+    def get_webhook_info(self, params):
+        info = {"url": self.webhook["url"], "has_custom_certificate": False, "pending_update_count": 0}
+        allowed = self.webhook["allowed_updates"]
+        if isinstance(allowed, str):
+            allowed = json.loads(allowed)
+        if allowed:
+            info["allowed_updates"] = allowed
+        return info
+
+    async def get_updates(self, params):
+        # long polling sem updates: segura até o timeout pedido (máx. 1s)
+        await asyncio.sleep(min(float(params.get("timeout") or 0), 1.0))
+        return []
+
+    # ---- HTTP ----
+    def _fault(self, method: str) -> Optional[web.Response]:
+        if self.fault_methods is not None and method not in self.fault_methods:
+            return None
+        roll = self._random.random()
+        if roll < self.rate_429:
+            self.faults["429"] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if roll < self.rate_429 + self.fail_rate:
+            self.faults["500"] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500
+            )
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+
+        if self.latency_ms or self.jitter_ms:
+            delay = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+            await asyncio.sleep(max(delay, 0.0) / 1000)
+
+        fault = self._fault(method)
+        if fault is not None:
+            return fault
+
+        if method in self.async_methods:
+            return web.json_response({"ok": True, "result": await self.async_methods[method](params)})
+        handler = self.methods.get(method)
+        if handler is None:
+            return web.json_response(
+                {"ok": False, "error_code": 404, "description": "Not Found: method not found"}, status=404
+            )
+        return web.json_response({"ok": True, "result": handler(params)})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser):
+    """Opções de injeção compartilhadas com o bench.loadtest."""
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="atraso de cada resposta")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="variação do atraso (±)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after devolvido no 429")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fração de respostas 500")
+    parser.add_argument("--fault-methods", help="métodos sujeitos a 429/500, separados por vírgula")
+    parser.add_argument("--seed", type=int, help="seed do sorteio de latência/falhas")
+
+
+def from_arguments(args) -> FakeTelegram:
+    methods = None
+    if args.fault_methods:
+        methods = {m.strip() for m in args.fault_methods.split(",") if m.strip()}
+    return FakeTelegram(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        fail_rate=args.fail_rate,
+        fault_methods=methods,
+        seed=args.seed,
+    )
+
+
+async def serve(fake: FakeTelegram, host: str, port: int):
+    url = await fake.start(host, port)
+    print(f"Telegram falso em {url} (use TELEGRAM_API_URL={url})", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bot API do Telegram falsa, para testes de carga")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    fake = from_arguments(args)
+    try:
+        asyncio.run(serve(fake, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print(f"chamadas: {dict(fake.calls)} falhas injetadas: {dict(fake.faults)}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
@@ -0,0 +1,239 @@
+"""
+Benchmark em processo do bot: sobe o `app` de verdade (startup/shutdown),
+aponta o bot (TELEGRAM_API_URL) para o Telegram falso local e roda o funil completo
+para N usuários sintéticos:
+
+    /start -> buy:30d|buy:life -> my_sub -> webhook Kiwify (src=token) -> my_sub
+
+Updates vão direto em dp.feed_update; o webhook passa pelo FastAPI via
+ASGITransport. Reporta p50/p95/p99 e vazão por fase.
+
+Uso:
+    python -m bench.loadtest --users 2000 --concurrency 50
+    python -m bench.loadtest --users 500 --json bench_output.json
+    python -m bench.loadtest --latency-ms 40 --rate-429 0.02 --real-limits
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import tempfile
+
+from bench.fake_telegram import add_fault_arguments
+
+
+def setup_env(args, tmpdir: str):
+    # antes de importar main: ele lê tudo do ambiente no import
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-token")
+    os.environ["DB_PATH"] = args.db or os.path.join(tmpdir, "bench.sqlite3")
+    os.environ.setdefault("CHANNEL_ID", "-1001000000000")
+    os.environ["TELEGRAM_MODE"] = "webhook"
+    os.environ.setdefault("TELEGRAM_WEBHOOK_URL", "http://bench.local")
+    # os updates vão direto no dispatcher; o segredo só precisa existir
+    os.environ.setdefault("TELEGRAM_WEBHOOK_SECRET", "bench-secret")
+    os.environ.pop("KIWIFY_WEBHOOK_TOKEN", None)
+    if not args.real_limits:
+        # mede o código, não o flood control (que existe para o Telegram real)
+        for name in ("TG_GLOBAL_RATE", "TG_CHAT_RATE", "TG_CHAT_BURST", "TG_ADMIN_RATE", "TG_ADMIN_BURST"):
+            os.environ[name] = "1000000"
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    k = max(min(round(q / 100 * len(values) + 0.5) - 1, len(values) - 1), 0)
+    return values[k]
+
+
+async def run_phase(name: str, users: int, concurrency: int, step) -> dict:
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with sem:
+            start = time.perf_counter()
+            try:
+                await step(i)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"[{name}] primeiro erro: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(users)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "phase": name,
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "elapsed_s": elapsed,
+    }
+
+
+class Funnel:
+    """Gera Updates/payloads sintéticos; usuário i tem telegram_id BASE + i."""
+
+    BASE_ID = 10_000_000
+
+    def __init__(self, main):
+        self.main = main
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.tokens = {}  # telegram_id -> token do pedido (o ?src= do link)
+
+    def user(self, i: int) -> dict:
+        return {"id": self.BASE_ID + i, "is_bot": False, "first_name": f"bench{i}"}
+
+    def email(self, i: int) -> str:
+        return f"bench{i}@bench.local"
+
+    def _message(self, i: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.BASE_ID + i, "type": "private"},
+            "from": self.user(i),
+            "text": text,
+        }
+
+    async def feed(self, payload: dict):
+        main = self.main
+        update = main.Update.model_validate(
+            {"update_id": next(self._update_ids), **payload}, context={"bot": main.bot}
+        )
+        await main.dp.feed_update(main.bot, update)
+
+    async def message(self, i: int, text: str):
+        await self.feed({"message": self._message(i, text)})
+
+    async def callback(self, i: int, data: str):
+        await self.feed({
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "chat_instance": "bench",
+                "from": self.user(i),
+                "message": self._message(i, "menu"),
+                "data": data,
+            }
+        })
+
+    async def load_tokens(self):
+        async with self.main.db_pool.read() as db:
+            cur = await db.execute("SELECT telegram_id, order_token FROM payments WHERE status='pending'")
+            self.tokens = dict(await cur.fetchall())
+            await cur.close()
+
+    def webhook_payload(self, i: int) -> dict:
+        return {
+            "order_id": f"bench-{i}",
+            "order_status": "paid",
+            "Customer": {"email": self.email(i)},
+            "TrackingParameters": {"src": self.tokens.get(self.BASE_ID + i)},
+        }
+
+
+async def bench(args) -> list:
+    import httpx
+    from bench.fake_telegram import from_arguments
+
+    fake = from_arguments(args)
+    os.environ["TELEGRAM_API_URL"] = await fake.start()
+    import main
+
+    funnel = Funnel(main)
+    results = []
+    await main.on_startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+            async def post_webhook(i: int):
+                r = await client.post("/kiwify/webhook", json=funnel.webhook_payload(i))
+                r.raise_for_status()
+
+            phases = [
+                ("cmd_start", lambda i: funnel.message(i, "/start")),
+                ("cb_choose_plan", lambda i: funnel.callback(i, "buy:30d" if i % 2 else "buy:life")),
+                ("cb_my_sub_pending", lambda i: funnel.callback(i, "my_sub")),
+                ("kiwify_webhook", post_webhook),
+            ]
+            for name, step in phases:
+                if name == "kiwify_webhook":
+                    # o token chegaria pelo checkout; aqui vem direto do DB
+                    await funnel.load_tokens()
+                results.append(await run_phase(name, args.users, args.concurrency, step))
+
+            # aprovação de ponta a ponta: fila -> DB -> grant_access -> Telegram
+            start = time.perf_counter()
+            await main.webhook_queue.join()
+            elapsed = time.perf_counter() - start + results[-1]["elapsed_s"]
+            results.append({
+                "phase": "webhook_processed",
+                "count": args.users,
+                "errors": 0,
+                "throughput": args.users / elapsed if elapsed else 0.0,
+                "elapsed_s": elapsed,
+            })
+
+            results.append(await run_phase(
+                "cb_my_sub_active", args.users, args.concurrency, lambda i: funnel.callback(i, "my_sub")
+            ))
+    finally:
+        await main.on_shutdown()
+        await fake.stop()
+
+    results.append({"phase": "telegram_calls", **dict(fake.calls)})
+    results.append({"phase": "telegram_faults", **dict(fake.faults)})
+    return results
+
+
+def print_report(results: list):
+    print(f"{'fase':<22}{'n':>7}{'erros':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>10}")
+    for r in results:
+        if r["phase"] in ("telegram_calls", "telegram_faults"):
+            calls = ", ".join(f"{k}={v}" for k, v in sorted(r.items()) if k != "phase") or "-"
+            title = "chamadas ao Telegram falso" if r["phase"] == "telegram_calls" else "falhas injetadas"
+            print(f"{title}: {calls}")
+            continue
+        cols = "".join(
+            f"{r[k]:>10.2f}" if k in r else f"{'-':>10}" for k in ("p50_ms", "p95_ms", "p99_ms", "max_ms")
+        )
+        print(f"{r['phase']:<22}{r['count']:>7}{r['errors']:>7}{cols}{r['throughput']:>10.1f}")
+
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark em processo do bot VIP")
+    parser.add_argument("--users", type=int, default=1000, help="usuários sintéticos no funil")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates simultâneos por fase")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: temporário, apagado no fim)")
+    parser.add_argument("--real-limits", action="store_true", help="mantém TG_*_RATE do ambiente")
+    parser.add_argument("--json", dest="json_path", help="grava os resultados em JSON")
+    add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="vip-bench-") as tmpdir:
+        setup_env(args, tmpdir)
+        results = asyncio.run(bench(args))
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(r.get("errors") for r in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
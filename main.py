@@ -1,17 +1,47 @@
+import io
 import os
 import re
+import sys
+import csv
+import codecs
+import hmac
+import json
+import math
+import sqlite3
+import argparse
+import time
+import bisect
 import base64
+import hashlib
+import secrets
+import heapq
 import asyncio
+import logging
+import functools
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Tuple
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import aiosqlite
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-
-from aiogram import Bot, Dispatcher, F
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from aiogram.filters import Command
 from aiogram.types import (
+    Update,
     Message,
     CallbackQuery,
     InlineKeyboardMarkup,
@@ -19,6 +49,7 @@ from aiogram.types import (
 )
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 
 
@@ -26,6 +57,10 @@ from aiogram.fsm.storage.memory import MemoryStorage
 # ENV
 # =========================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+
+# Canal/planos padrão: semeiam o catálogo (tabelas channels/products) quando ele
+# está vazio; depois, mudar PRICE_*/SUB_DAYS/KIWIFY_*/PRODUCT_NAME no env atualiza
+# os planos 30d/life no próximo start. O resto do catálogo (vários canais) é só no DB.
 CHANNEL_ID = os.getenv("CHANNEL_ID", "").strip()
 
 PRODUCT_NAME = os.getenv("PRODUCT_NAME", "Acesso Canal VIP").strip()
@@ -40,26 +75,811 @@ SUB_DAYS = int(os.getenv("SUB_DAYS", "30"))
 KIWIFY_LINK_30 = os.getenv("KIWIFY_LINK_30", "https://pay.kiwify.com.br/TvLqICI").strip()
 KIWIFY_LINK_LIFE = os.getenv("KIWIFY_LINK_LIFE", "https://pay.kiwify.com.br/PAd2mH9").strip()
 
+# IDs dos produtos na Kiwify (opcional): o webhook roteia a aprovação pelo produto
+KIWIFY_PRODUCT_30 = os.getenv("KIWIFY_PRODUCT_30", "").strip()
+KIWIFY_PRODUCT_LIFE = os.getenv("KIWIFY_PRODUCT_LIFE", "").strip()
+
+# De quanto em quanto tempo cada instância confere se o catálogo mudou
+CATALOG_POLL_INTERVAL = float(os.getenv("CATALOG_POLL_INTERVAL", "30"))  # segundos
+
 # Webhook token (opcional, mas recomendado)
 KIWIFY_WEBHOOK_TOKEN = os.getenv("KIWIFY_WEBHOOK_TOKEN", "").strip()
 
+# Limites de envio para a API do Telegram (flood control)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))  # mensagens/s no bot todo
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))       # mensagens/s por chat
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+# métodos administrativos no canal (links de convite, ban/unban) têm limite próprio
+TG_ADMIN_RATE = float(os.getenv("TG_ADMIN_RATE", "20"))   # chamadas/s por canal
+TG_ADMIN_BURST = float(os.getenv("TG_ADMIN_BURST", "20"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# Pool de links de convite pré-gerados (1 uso cada)
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "20"))
+INVITE_POOL_LOW = int(os.getenv("INVITE_POOL_LOW", "5"))
+INVITE_LINK_TTL_MIN = int(os.getenv("INVITE_LINK_TTL_MIN", "60"))
+INVITE_MIN_REMAINING_MIN = int(os.getenv("INVITE_MIN_REMAINING_MIN", "10"))
+
+# Quantos eventos da Kiwify são processados em paralelo
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+# evento que falhou volta para a fila depois de base * 2^tentativa (até o máximo)
+WEBHOOK_RETRY_BASE = float(os.getenv("WEBHOOK_RETRY_BASE", "5"))   # segundos
+WEBHOOK_RETRY_MAX = float(os.getenv("WEBHOOK_RETRY_MAX", "300"))   # segundos
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))  # depois disso: result="failed"
+
+# Várias réplicas no mesmo DB: cada evento do inbox é reivindicado por uma
+# instância (claim com prazo) e os jobs de expiração/lembrete rodam numa só (lease).
+INSTANCE_ID = os.getenv("INSTANCE_ID", "").strip() or secrets.token_hex(6)
+WEBHOOK_CLAIM_TTL = int(os.getenv("WEBHOOK_CLAIM_TTL", "600"))        # segundos
+INBOX_REPLAY_INTERVAL = int(os.getenv("INBOX_REPLAY_INTERVAL", "60"))  # segundos
+JOB_LEASE_TTL = int(os.getenv("JOB_LEASE_TTL", "300"))                # segundos
+JOB_LEASE_RETRY = float(os.getenv("JOB_LEASE_RETRY", "5"))            # segundos
+
 DB_PATH = os.getenv("DB_PATH", "db.sqlite3")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+# Tuning do SQLite (aplicado em toda conexão do pool)
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL").strip().upper()
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-16000"))  # negativo = KiB
+
+# Pedidos pendentes abandonados são apagados depois de N dias
+PENDING_RETENTION_DAYS = int(os.getenv("PENDING_RETENTION_DAYS", "30"))
+PENDING_COMPACT_INTERVAL = int(os.getenv("PENDING_COMPACT_INTERVAL", "3600"))  # segundos
+
+# Cache do status de assinatura por telegram_id ("Minha assinatura")
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "10000"))
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "30"))  # segundos
+
+# Remoção automática de assinantes vencidos do canal. O agendador dispara no
+# horário exato; a varredura periódica é só rede de segurança.
+EXPIRY_SWEEP_INTERVAL = int(os.getenv("EXPIRY_SWEEP_INTERVAL", "3600"))  # segundos
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", "100"))
+REMINDER_DAYS = int(os.getenv("REMINDER_DAYS", "3"))  # aviso de renovação antes de vencer
+SCHEDULER_WINDOW = int(os.getenv("SCHEDULER_WINDOW", "500"))  # próximas expirações em memória
+
+# Write-behind: escritas pequenas agrupadas numa transação só
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "64"))
+DB_BATCH_WINDOW_MS = float(os.getenv("DB_BATCH_WINDOW_MS", "2"))
+
+# Estado das conversas (FSM): "sqlite" (mesmo DB_PATH), "redis" ou "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0").strip()
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))  # segundos
+
+# Export/import administrativo (/admin/*). Sem token = desligado.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "5000"))
+
+# Recebimento de updates do Telegram: "polling" (padrão) ou "webhook".
+# Em webhook várias instâncias podem rodar atrás de um load balancer.
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling").strip().lower()
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").strip().rstrip("/")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook").strip()
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "").strip()
+
+# Bot API alternativa (ex.: `python -m bench.fake_telegram` em teste de carga).
+# Vazio = api.telegram.org.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+
+# Filtro (bloom) de emails cadastrados: webhook de email desconhecido nem toca no DB.
+# O filtro é por processo, então só liga por padrão em polling (1 instância);
+# com várias réplicas o email pode ter sido cadastrado em outra.
+EMAIL_FILTER = os.getenv("EMAIL_FILTER", "1" if TELEGRAM_MODE == "polling" else "0") == "1"
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY", "1000000"))
+EMAIL_FILTER_FP_RATE = float(os.getenv("EMAIL_FILTER_FP_RATE", "0.001"))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN não configurado")
 
+if TELEGRAM_MODE not in ("polling", "webhook"):
+    raise RuntimeError("TELEGRAM_MODE deve ser 'polling' ou 'webhook'")
+
+if TELEGRAM_MODE == "webhook" and not TELEGRAM_WEBHOOK_URL:
+    raise RuntimeError("TELEGRAM_WEBHOOK_URL não configurado (obrigatório com TELEGRAM_MODE=webhook)")
+
+# sem o segredo qualquer um poderia postar updates forjados no endpoint
+if TELEGRAM_MODE == "webhook" and not TELEGRAM_WEBHOOK_SECRET:
+    raise RuntimeError("TELEGRAM_WEBHOOK_SECRET não configurado (obrigatório com TELEGRAM_MODE=webhook)")
+
+if TELEGRAM_WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", TELEGRAM_WEBHOOK_SECRET):
+    raise RuntimeError("TELEGRAM_WEBHOOK_SECRET: use 1-256 caracteres A-Z, a-z, 0-9, _ ou -")
+
 
 # =========================
 # BOT + FASTAPI
 # =========================
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+log = logging.getLogger("vip_bot")
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(BOT_TOKEN, session=session)
 app = FastAPI()
 
 
+# =========================
+# Métricas (Prometheus)
+# =========================
+# Implementação mínima do formato texto do Prometheus: tudo roda no mesmo
+# event loop, então registrar é só somar num dict (sem lock, sem dependência).
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+metrics_registry = []
+
+
+def _metric_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._values = {}
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_metric_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: Tuple[str, ...] = (), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [contagem por bucket (+Inf no fim), soma]
+        metrics_registry.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                yield f"{self.name}_bucket{_metric_labels(names, labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_metric_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_metric_labels(self.labelnames, labels)} {cumulative}"
+
+
+class CollectedMetric:
+    """Valor lido só na hora do scrape (tamanho de fila, stats que já existem)."""
+
+    def __init__(self, name: str, doc: str, kind: str, labelnames: Tuple[str, ...], read):
+        self.name = name
+        self.doc = doc
+        self.kind = kind
+        self.labelnames = labelnames
+        self.read = read  # -> número, ou {labels: número}
+        metrics_registry.append(self)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_metric_labels(self.labelnames, labels)} {value}"
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram, label: Optional[str] = None):
+    """Decorator: observa a duração de uma corrotina em `histogram` (label = nome da função)."""
+    def decorator(fn):
+        name = label or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+WEBHOOK_LATENCY = Histogram(
+    "vip_kiwify_webhook_seconds", "Latência do webhook Kiwify (request e processamento)", ("step",)
+)
+HANDLER_LATENCY = Histogram(
+    "vip_handler_seconds", "Latência dos handlers do bot", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "vip_handler_errors_total", "Exceções nos handlers do bot", ("handler",)
+)
+DB_LATENCY = Histogram(
+    "vip_db_seconds", "Latência das funções de acesso ao banco", ("helper",)
+)
+TG_API_LATENCY = Histogram(
+    "vip_telegram_api_seconds", "Latência das chamadas à API do Telegram", ("method",)
+)
+TG_API_ERRORS = Counter(
+    "vip_telegram_api_errors_total", "Erros nas chamadas à API do Telegram", ("method", "error")
+)
+EMAIL_FILTER_LOOKUPS = Counter(
+    "vip_email_filter_lookups_total", "Consultas ao filtro de emails no webhook", ("result",)
+)
+KIWIFY_UNKNOWN_TOKENS = Counter(
+    "vip_kiwify_unknown_tokens_total", "Webhooks Kiwify com token de pedido (src) que não casou com nenhum pedido"
+)
+
+
+class HandlerMetrics(BaseMiddleware):
+    """Middleware interno do dispatcher: mede cada handler pelo nome da função."""
+
+    async def __call__(self, handler, event, data):
+        obj = data.get("handler")
+        name = obj.callback.__name__ if obj is not None else "unknown"
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+
+class TelegramAPIMetrics(BaseRequestMiddleware):
+    """Middleware da sessão, por dentro da fila de envio: mede só a chamada HTTP."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TG_API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TG_API_LATENCY.observe(time.perf_counter() - start, name)
+
+
+# =========================
+# Telegram: fila de envio (limites de flood)
+# =========================
+# Prioridades: menor sai primeiro
+PRIORITY_ACCESS = 0      # link de acesso de quem pagou
+PRIORITY_REPLY = 1       # respostas normais dos handlers
+PRIORITY_BACKGROUND = 2  # jobs (lembretes, limpezas, pré-geração)
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_REPLY)
+
+# só estes contam no limite de mensagens por chat; os demais com chat_id
+# (createChatInviteLink, banChatMember...) vão para o bucket administrativo do chat
+MESSAGE_METHODS = frozenset({
+    "SendMessage",
+    "SendPhoto",
+    "SendDocument",
+    "SendVideo",
+    "SendAnimation",
+    "SendAudio",
+    "SendVoice",
+    "SendMediaGroup",
+    "CopyMessage",
+    "ForwardMessage",
+    "EditMessageText",
+    "EditMessageCaption",
+    "EditMessageMedia",
+    "EditMessageReplyMarkup",
+})
+
+@contextmanager
+def priority(level: int):
+    token = send_priority.set(level)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = 0.0
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        if self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Segundos até ter 1 token (0 = pode enviar já)."""
+        self._refill(now)
+        wait = max(self.paused_until - now, 0.0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.paused_until <= now
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Middleware da sessão do bot: toda chamada com chat_id passa por um
+    token bucket global + um por chat, em ordem de prioridade, e é
+    repetida respeitando o retry_after quando o Telegram devolve 429.
+    Mensagens usam o bucket de mensagens do chat; métodos administrativos
+    (convites, ban/unban no canal) usam um bucket separado, com limite próprio.
+    """
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        max_retries: int,
+        admin_rate: float,
+        admin_burst: float,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.admin_rate = admin_rate
+        self.admin_burst = admin_burst
+        self.max_retries = max_retries
+        self.chats = {}
+        self._waiters = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {
+            "sent": 0,
+            "retry_after": 0,
+            "server_errors": 0,
+            "failed": 0,
+            "queued_max": 0,
+        }
+
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def queue_depth_by_priority(self) -> dict:
+        depth = {}
+        for prio, _seq, _chat, _fut in self._waiters:
+            depth[prio] = depth.get(prio, 0) + 1
+        return depth
+
+    def _chat_bucket(self, key) -> TokenBucket:
+        """key = chat_id (mensagens) ou ("admin", chat_id)."""
+        bucket = self.chats.get(key)
+        if bucket is None:
+            if len(self.chats) > 10000:
+                now = asyncio.get_running_loop().time()
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle(now)}
+            if isinstance(key, tuple):
+                bucket = TokenBucket(self.admin_rate, self.admin_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chats[key] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, prio: int):
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (prio, self._seq, chat_id, fut))
+        self.stats["queued_max"] = max(self.stats["queued_max"], len(self._waiters))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # sai da fila se quem pediu desistiu
+            self._waiters = [w for w in self._waiters if w[3] is not fut]
+            heapq.heapify(self._waiters)
+            raise
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self._waiters:
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            sleep_for = self.global_bucket.delay(now)
+            if sleep_for <= 0:
+                sleep_for = self._grant_next(now)
+                if sleep_for <= 0:
+                    continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant_next(self, now: float) -> float:
+        """Libera o pedido mais prioritário cujo chat está livre; senão, quanto esperar."""
+        wait = 0.0
+        for waiter in sorted(self._waiters):
+            bucket = self._chat_bucket(waiter[2])
+            chat_delay = bucket.delay(now)
+            if chat_delay <= 0:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self.global_bucket.take(now)
+                bucket.take(now)
+                if not waiter[3].done():
+                    waiter[3].set_result(None)
+                return 0.0
+            wait = chat_delay if not wait else min(wait, chat_delay)
+        return wait
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # answerCallbackQuery, getUpdates... não contam para o limite de mensagens
+            return await make_request(bot, method)
+
+        key = chat_id if type(method).__name__ in MESSAGE_METHODS else ("admin", chat_id)
+        prio = send_priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(key, prio)
+            try:
+                response = await make_request(bot, method)
+                self.stats["sent"] += 1
+                return response
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                now = asyncio.get_running_loop().time()
+                self._chat_bucket(key).pause(now, e.retry_after)
+                log.warning("429 em %s (chat %s): aguardando %ss", type(method).__name__, chat_id, e.retry_after)
+            except TelegramServerError:
+                self.stats["server_errors"] += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.stats["failed"] += 1
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+
+send_scheduler = SendScheduler(
+    TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_MAX_RETRIES, TG_ADMIN_RATE, TG_ADMIN_BURST
+)
+bot.session.middleware(send_scheduler)
+bot.session.middleware(TelegramAPIMetrics())
+
+
 # =========================
 # DB
 # =========================
+async def db_configure(conn: aiosqlite.Connection, readonly: bool = False):
+    """
+    Pragmas por conexão. Em WAL leitores não bloqueiam atrás do escritor;
+    synchronous=NORMAL só faz fsync no checkpoint (seguro em WAL).
+    """
+    # journal_mode é persistente no arquivo; só o escritor precisa trocar
+    if not readonly:
+        cur = await conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        (mode,) = await cur.fetchone()
+        await cur.close()
+        if mode.upper() != DB_JOURNAL_MODE:
+            log.warning("journal_mode=%s não aplicado (ficou %s)", DB_JOURNAL_MODE, mode)
+    await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    await conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    await conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    await conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    if readonly:
+        await conn.execute("PRAGMA query_only=1")
+
+
+class WriteResult(NamedTuple):
+    lastrowid: Optional[int]
+    rowcount: int
+    row: Optional[tuple] = None  # primeira linha do RETURNING, se houver
+
+
+class DBPool:
+    """
+    Conexões aiosqlite de longa duração, abertas no startup:
+    N leitores reaproveitados + 1 escritor serializado por lock.
+
+    enqueue() agrupa escritas de vários handlers numa transação
+    (até batch_max itens ou batch_window_ms) e só retorna após o COMMIT.
+    """
+
+    def __init__(self, path: str, readers: int, batch_max: int = 64, batch_window_ms: float = 2):
+        self.path = path
+        self.size = max(readers, 1)
+        self.batch_max = max(batch_max, 1)
+        self.batch_window = max(batch_window_ms, 0) / 1000
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all_readers = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._pending: asyncio.Queue = asyncio.Queue()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        # isolation_level=None: transações só onde pedirmos (write())
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        await db_configure(conn, readonly=readonly)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        # escritor primeiro: é ele que troca o journal_mode do arquivo
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            conn = await self._connect(readonly=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        # drena a fila de escrita antes de fechar
+        if self._flusher is not None:
+            self._pending.put_nowait(None)
+            await self._flusher
+            self._flusher = None
+        # espera escrita em andamento terminar antes de fechar
+        async with self._write_lock:
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        self._pending = asyncio.Queue()
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def dedicated(self):
+        """Conexão de leitura avulsa para operações longas (export) sem ocupar o pool."""
+        conn = await self._connect(readonly=True)
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            if self._writer is None:
+                raise RuntimeError("DB não inicializado (db_pool.open() não foi chamado)")
+            db = self._writer
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                if db.in_transaction:
+                    await db.execute("ROLLBACK")
+                raise
+            else:
+                await db.execute("COMMIT")
+
+    def pending_writes(self) -> int:
+        return self._pending.qsize()
+
+    async def enqueue(self, sql: str, params=()) -> WriteResult:
+        """Escrita agrupada; retorna depois que o lote foi commitado."""
+        if self._flusher is None:
+            raise RuntimeError("DB não inicializado (db_pool.open() não foi chamado)")
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((sql, params, fut))
+        return await fut
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_max:
+                try:
+                    nxt = self._pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        nxt = await asyncio.wait_for(self._pending.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        results = []
+        try:
+            async with self.write() as db:
+                for sql, params, fut in batch:
+                    # savepoint por item: um erro não derruba o lote inteiro
+                    await db.execute("SAVEPOINT w")
+                    try:
+                        cur = await db.execute(sql, params)
+                        rows = await cur.fetchall() if cur.description else []
+                        results.append(WriteResult(cur.lastrowid, cur.rowcount, tuple(rows[0]) if rows else None))
+                        await cur.close()
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO w")
+                        results.append(e)
+                    await db.execute("RELEASE w")
+        except Exception as e:
+            for _sql, _params, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        # só acorda os chamadores depois do COMMIT (durável)
+        for (_sql, _params, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+
+db_pool = DBPool(DB_PATH, DB_READERS, DB_BATCH_MAX, DB_BATCH_WINDOW_MS)
+
+
+class TTLCache:
+    """
+    LRU limitado a maxsize com TTL por entrada. Guarda também resultados
+    None (usuário sem pedido). set() descarta o valor se houve invalidate()
+    da mesma chave (ou clear()) depois que a leitura começou, para não
+    repovoar com dado velho; as outras chaves não são afetadas.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._clock = 0
+        # chave -> _clock do último invalidate (limitado a maxsize; o que sai
+        # daqui sobe _floor, que vale para todas as chaves)
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def generation(self) -> int:
+        return self._clock
+
+    def get(self, key):
+        """Retorna (achou, valor)."""
+        item = self._data.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, item[1]
+        if item is not None:
+            del self._data[key]
+        self.stats["misses"] += 1
+        return False, None
+
+    def set(self, key, value, generation: Optional[int] = None):
+        if generation is not None:
+            if generation < self._floor or self._invalidated.get(key, -1) > generation:
+                return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self._clock += 1
+        self._floor = self._clock
+        self._invalidated.clear()
+        self._data.clear()
+
+    def invalidate(self, key):
+        self._clock += 1
+        self.stats["invalidations"] += 1
+        self._invalidated[key] = self._clock
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            _key, clock = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, clock)
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+sub_cache = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_TTL)
+
+
+class BloomFilter:
+    """
+    Conjunto probabilístico de tamanho fixo: "não está" é certeza,
+    "está" pode ser falso positivo (~fp_rate com capacity itens).
+    """
+
+    def __init__(self, capacity: int, fp_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+# só é consultado depois de carregado do DB no startup
+known_emails: Optional[BloomFilter] = None
+
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS payments (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -73,121 +893,1091 @@ CREATE TABLE IF NOT EXISTS payments (
 );
 """
 
-async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(CREATE_TABLE_SQL)
-
-        # Migrações simples (caso o DB já exista antigo)
-        for stmt in [
-            "ALTER TABLE payments ADD COLUMN email TEXT",
-            "ALTER TABLE payments ADD COLUMN approved_at TEXT",
-            "ALTER TABLE payments ADD COLUMN expires_at TEXT",
-            "ALTER TABLE payments ADD COLUMN plan TEXT",
-            "ALTER TABLE payments ADD COLUMN id INTEGER",
-        ]:
-            try:
-                await db.execute(stmt)
-            except Exception:
-                pass
+SQL_LATEST_BY_TELEGRAM = """
+SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
+FROM payments
+WHERE telegram_id=?
+ORDER BY created_at DESC, id DESC
+LIMIT 1
+"""
 
-        await db.commit()
+SQL_LATEST_BY_EMAIL = """
+SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
+FROM payments
+WHERE email=?
+ORDER BY created_at DESC, id DESC
+LIMIT 1
+"""
 
-async def db_create_pending(telegram_id: int, plan: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+SQL_LATEST_BY_EMAIL_PLAN = """
+SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
+FROM payments
+WHERE email=? AND plan=?
+ORDER BY created_at DESC, id DESC
+LIMIT 1
+"""
+
+SQL_BY_ORDER_TOKEN = """
+SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
+FROM payments
+WHERE order_token=?
+"""
+
+SQL_ATTACH_EMAIL = """
+UPDATE payments
+SET email=?
+WHERE id = (
+  SELECT id FROM payments
+  WHERE telegram_id=?
+  ORDER BY created_at DESC, id DESC
+  LIMIT 1
+)
+"""
+
+# Migrações versionadas por PRAGMA user_version.
+# Colunas que DBs antigos podem não ter (antes eram ALTERs "às cegas" no boot)
+LEGACY_COLUMNS = [
+    ("email", "TEXT"),
+    ("approved_at", "TEXT"),
+    ("expires_at", "TEXT"),
+    ("plan", "TEXT"),
+    ("id", "INTEGER"),
+]
+
+async def _table_columns(db, table: str) -> set:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    cols = {r[1] for r in await cur.fetchall()}
+    await cur.close()
+    return cols
+
+async def _m001_base(db):
+    await db.execute(CREATE_TABLE_SQL)
+    cols = await _table_columns(db, "payments")
+    for name, decl in LEGACY_COLUMNS:
+        if name not in cols:
+            await db.execute(f"ALTER TABLE payments ADD COLUMN {name} {decl}")
+
+    # lookups "último pedido por email/telegram"; o índice (telegram_id, created_at)
+    # também cobre o subselect de db_attach_email_latest
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_email_created ON payments(email, created_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_telegram_created ON payments(telegram_id, created_at)")
+
+async def _m002_pending_unique(db):
+    # pedidos pendentes repetidos do mesmo (telegram_id, plan): mantém o mais recente
+    # e marca os outros como "superseded" (não apaga: o email pode casar com um webhook)
+    await db.execute(
+        """
+        UPDATE payments SET status='superseded'
+        WHERE status='pending' AND id NOT IN (
+          SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+              PARTITION BY telegram_id, plan ORDER BY created_at DESC, id DESC
+            ) AS rn
+            FROM payments WHERE status='pending'
+          ) WHERE rn = 1
+        )
+        """
+    )
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_payments_open_order "
+        "ON payments(telegram_id, plan) WHERE status='pending'"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_stale_created "
+        "ON payments(created_at) WHERE status IN ('pending', 'superseded')"
+    )
+
+async def _m003_webhook_inbox(db):
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          payload TEXT NOT NULL,
+          received_at TEXT NOT NULL,
+          processed_at TEXT,
+          result TEXT
+        )
+        """
+    )
+
+async def _m004_inbox_idempotency(db):
+    await db.execute("ALTER TABLE webhook_inbox ADD COLUMN order_id TEXT")
+    # NULLs não colidem: eventos sem order_id continuam entrando
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_inbox_order ON webhook_inbox(order_id)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_inbox_unprocessed ON webhook_inbox(id) WHERE processed_at IS NULL"
+    )
+
+async def _m005_fsm_state(db):
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+          key TEXT PRIMARY KEY,
+          state TEXT,
+          data TEXT NOT NULL DEFAULT '{}',
+          updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+
+async def _m006_expiry_sweep(db):
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_expiry ON payments(expires_at, id) "
+        "WHERE status='approved' AND expires_at IS NOT NULL"
+    )
+    # progresso dos jobs (checkpoint) para retomar depois de restart
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS job_state (
+          name TEXT PRIMARY KEY,
+          value TEXT NOT NULL,
+          updated_at TEXT NOT NULL
+        )
+        """
+    )
+
+def _iso_to_epoch(value) -> int:
+    if isinstance(value, (int, float)):
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+async def _m007_epoch_timestamps(db):
+    # SQLite não muda tipo de coluna: recria a tabela com INTEGER (epoch em segundos)
+    await db.execute(
+        """
+        CREATE TABLE payments_new (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          telegram_id INTEGER NOT NULL,
+          email TEXT,
+          status TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          approved_at INTEGER,
+          expires_at INTEGER,
+          plan TEXT NOT NULL
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO payments_new(id, telegram_id, email, status, created_at, approved_at, expires_at, plan)
+        SELECT id, telegram_id, email, status,
+               COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0),
+               CAST(strftime('%s', approved_at) AS INTEGER),
+               CAST(strftime('%s', expires_at) AS INTEGER),
+               COALESCE(plan, '30d')
+        FROM payments
+        """
+    )
+    # strftime devolve NULL para data que não parseia: registra para o suporte
+    cur = await db.execute(
+        """
+        SELECT p.id, p.telegram_id, p.expires_at FROM payments p JOIN payments_new n ON n.id = p.id
+        WHERE p.expires_at IS NOT NULL AND n.expires_at IS NULL
+        """
+    )
+    for row_id, telegram_id, expires_at in await cur.fetchall():
+        log.warning("expires_at inválido descartado: pagamento %s telegram_id=%s valor=%r", row_id, telegram_id, expires_at)
+    await cur.close()
+    await db.execute("DROP TABLE payments")
+    await db.execute("ALTER TABLE payments_new RENAME TO payments")
+
+    await db.execute("CREATE INDEX idx_payments_email_created ON payments(email, created_at)")
+    await db.execute("CREATE INDEX idx_payments_telegram_created ON payments(telegram_id, created_at)")
+    await db.execute("CREATE UNIQUE INDEX uq_payments_open_order ON payments(telegram_id, plan) WHERE status='pending'")
+    await db.execute(
+        "CREATE INDEX idx_payments_stale_created "
+        "ON payments(created_at) WHERE status IN ('pending', 'superseded')"
+    )
+    await db.execute(
+        "CREATE INDEX idx_payments_expiry ON payments(expires_at, id) "
+        "WHERE status='approved' AND expires_at IS NOT NULL"
+    )
+
+    # checkpoints dos jobs guardavam expires_at em ISO
+    for name in ("expiry_sweep", "reminder_sweep"):
+        cur = await db.execute("SELECT value FROM job_state WHERE name=?", (name,))
+        row = await cur.fetchone()
+        await cur.close()
+        if row:
+            after_expires, after_id = json.loads(row[0])
+            value = [_iso_to_epoch(after_expires) if after_expires else 0, after_id]
+            await db.execute("UPDATE job_state SET value=? WHERE name=?", (json.dumps(value), name))
+
+async def _m008_subscriptions(db):
+    # estado atual: 1 linha por usuário (expires_at NULL = vitalícia);
+    # payments fica como histórico de pedidos/aprovações
+    await db.execute(
+        """
+        CREATE TABLE subscriptions (
+          telegram_id INTEGER PRIMARY KEY,
+          plan TEXT NOT NULL,
+          expires_at INTEGER,
+          payment_id INTEGER,
+          updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO subscriptions(telegram_id, plan, expires_at, payment_id, updated_at)
+        SELECT telegram_id,
+               CASE WHEN SUM(plan='life') > 0 THEN 'life' ELSE '30d' END,
+               CASE WHEN SUM(plan='life') > 0 THEN NULL ELSE MAX(expires_at) END,
+               MAX(id),
+               CAST(strftime('%s', 'now') AS INTEGER)
+        FROM payments
+        WHERE status='approved'
+        GROUP BY telegram_id
+        HAVING SUM(plan='life') > 0 OR MAX(expires_at) IS NOT NULL
+        """
+    )
+    # vitalícia só com plan='life'. Aprovado de 30 dias sem expires_at (DB antigo)
+    # fica de fora: "Minha assinatura" manda falar com o suporte, como antes
+    cur = await db.execute(
+        """
+        SELECT telegram_id, GROUP_CONCAT(id) FROM payments
+        WHERE status='approved'
+        GROUP BY telegram_id
+        HAVING SUM(plan='life') = 0 AND MAX(expires_at) IS NULL
+        """
+    )
+    for telegram_id, ids in await cur.fetchall():
+        log.warning("assinatura sem data de expiração não migrada: telegram_id=%s pagamentos=%s", telegram_id, ids)
+    await cur.close()
+    await db.execute(
+        "CREATE INDEX idx_subscriptions_expiry ON subscriptions(expires_at, telegram_id) "
+        "WHERE expires_at IS NOT NULL"
+    )
+    # varreduras agora leem subscriptions
+    await db.execute("DROP INDEX IF EXISTS idx_payments_expiry")
+    for name in ("expiry_sweep", "reminder_sweep"):
+        cur = await db.execute("SELECT value FROM job_state WHERE name=?", (name,))
+        row = await cur.fetchone()
+        await cur.close()
+        if row:
+            after_expires, _payment_id = json.loads(row[0])
+            await db.execute(
+                "UPDATE job_state SET value=? WHERE name=?", (json.dumps([after_expires, 0]), name)
+            )
+
+async def _m009_catalog(db):
+    # catálogo: canais e planos (code = payments.plan / subscriptions.plan)
+    await db.execute(
+        """
+        CREATE TABLE channels (
+          id INTEGER PRIMARY KEY,  -- chat_id do Telegram; 0 = canal padrão ainda sem CHANNEL_ID
+          name TEXT NOT NULL,
+          active INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE products (
+          code TEXT PRIMARY KEY,
+          channel_id INTEGER NOT NULL,
+          label TEXT NOT NULL,
+          price REAL NOT NULL,
+          duration_days INTEGER,  -- NULL = vitalício
+          checkout_url TEXT NOT NULL,
+          kiwify_product_id TEXT UNIQUE,
+          position INTEGER NOT NULL DEFAULT 0,
+          active INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    # toda mudança no catálogo sobe a versão; as instâncias recarregam ao ver
+    await db.execute("CREATE TABLE catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    await db.execute("INSERT INTO catalog_version(id, version) VALUES (1, 1)")
+    for table in ("channels", "products"):
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            await db.execute(
+                f"""
+                CREATE TRIGGER trg_{table}_{op.lower()}_version AFTER {op} ON {table}
+                BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END
+                """
+            )
+
+    # assinatura passa a ser por (usuário, canal); as que existem são do canal do env
+    await db.execute(
+        """
+        CREATE TABLE subscriptions_new (
+          telegram_id INTEGER NOT NULL,
+          channel_id INTEGER NOT NULL,
+          plan TEXT NOT NULL,
+          expires_at INTEGER,
+          payment_id INTEGER,
+          updated_at INTEGER NOT NULL,
+          PRIMARY KEY (telegram_id, channel_id)
+        ) WITHOUT ROWID
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO subscriptions_new(telegram_id, channel_id, plan, expires_at, payment_id, updated_at)
+        SELECT telegram_id, ?, plan, expires_at, payment_id, updated_at FROM subscriptions
+        """,
+        (int(CHANNEL_ID or 0),)
+    )
+    await db.execute("DROP TABLE subscriptions")
+    await db.execute("ALTER TABLE subscriptions_new RENAME TO subscriptions")
+    await db.execute(
+        "CREATE INDEX idx_subscriptions_expiry ON subscriptions(expires_at, telegram_id, channel_id) "
+        "WHERE expires_at IS NOT NULL"
+    )
+    for name in ("expiry_sweep", "reminder_sweep"):
+        cur = await db.execute("SELECT value FROM job_state WHERE name=?", (name,))
+        row = await cur.fetchone()
+        await cur.close()
+        if row:
+            after_expires, _after_id = json.loads(row[0])
+            await db.execute(
+                "UPDATE job_state SET value=? WHERE name=?", (json.dumps([after_expires, 0, 0]), name)
+            )
+
+async def _m010_order_token(db):
+    # token do pedido vai no link de checkout (src) e volta no webhook da Kiwify
+    await db.execute("ALTER TABLE payments ADD COLUMN order_token TEXT")
+    await db.execute(
+        "CREATE UNIQUE INDEX uq_payments_order_token ON payments(order_token) WHERE order_token IS NOT NULL"
+    )
+
+async def _m011_kiwify_order(db):
+    # pedido da Kiwify que aprovou a linha: distingue reentrega de pagamento novo
+    # feito por um link antigo (token de pedido já aprovado)
+    await db.execute("ALTER TABLE payments ADD COLUMN kiwify_order_id TEXT")
+    await db.execute(
+        "CREATE UNIQUE INDEX uq_payments_kiwify_order ON payments(kiwify_order_id) WHERE kiwify_order_id IS NOT NULL"
+    )
+
+async def _m012_inbox_claim(db):
+    # instância que está processando o evento e até quando (réplicas no mesmo DB)
+    await db.execute("ALTER TABLE webhook_inbox ADD COLUMN claimed_by TEXT")
+    await db.execute("ALTER TABLE webhook_inbox ADD COLUMN claimed_until INTEGER")
+
+# posição na lista + 1 = versão do schema; só acrescente no final
+MIGRATIONS = [
+    _m001_base,
+    _m002_pending_unique,
+    _m003_webhook_inbox,
+    _m004_inbox_idempotency,
+    _m005_fsm_state,
+    _m006_expiry_sweep,
+    _m007_epoch_timestamps,
+    _m008_subscriptions,
+    _m009_catalog,
+    _m010_order_token,
+    _m011_kiwify_order,
+    _m012_inbox_claim,
+]
+
+async def _db_user_version(db) -> int:
+    cur = await db.execute("PRAGMA user_version")
+    (version,) = await cur.fetchone()
+    await cur.close()
+    return version
+
+async def db_init():
+    target = len(MIGRATIONS)
+
+    # caminho comum: DB já atualizado => só uma leitura de pragma
+    async with db_pool.read() as db:
+        version = await _db_user_version(db)
+    if version == target:
+        return
+    if version > target:
+        raise RuntimeError(f"DB na versão {version}, mais nova que o código ({target})")
+
+    async with db_pool.write() as db:
+        # relê dentro da transação: outra instância pode ter migrado antes
+        version = await _db_user_version(db)
+        for step in range(version, target):
+            log.info("aplicando migração %d (%s)", step + 1, MIGRATIONS[step].__name__)
+            await MIGRATIONS[step](db)
+        await db.execute(f"PRAGMA user_version = {target}")
+
+async def db_check_query_plans():
+    """
+    Confere via EXPLAIN QUERY PLAN que os lookups quentes usam os índices
+    (sem SCAN na tabela nem ORDER BY em B-tree temporária).
+    Conexão nova: os leitores do pool abriram antes das migrações e o
+    EXPLAIN neles ainda vê o schema antigo.
+    """
+    ok = True
+    async with db_pool.dedicated() as db:
+        for name, sql, params in [
+            ("latest_by_telegram", SQL_LATEST_BY_TELEGRAM, (0,)),
+            ("latest_by_email", SQL_LATEST_BY_EMAIL, ("",)),
+            ("attach_email", SQL_ATTACH_EMAIL, ("", 0)),
+            ("by_order_token", SQL_BY_ORDER_TOKEN, ("",)),
+        ]:
+            cur = await db.execute("EXPLAIN QUERY PLAN " + sql, params)
+            details = [r[-1] for r in await cur.fetchall()]
+            await cur.close()
+            bad = [d for d in details if d.startswith("SCAN payments") or "TEMP B-TREE" in d]
+            if bad:
+                ok = False
+                log.warning("query plan sem índice em %s: %s", name, "; ".join(bad))
+    return ok
+
+@timed(DB_LATENCY)
+async def db_create_pending(telegram_id: int, plan: str) -> str:
+    """Retorna o token do pedido (o mesmo se o pedido aberto já existia)."""
+    # um pedido aberto por (telegram_id, plan): clicar de novo só "renova" o pedido,
+    # e o link enviado antes continua valendo
+    res = await db_pool.enqueue(
+        """
+        INSERT INTO payments(telegram_id, email, status, created_at, approved_at, expires_at, plan, order_token)
+        VALUES (?,?,?,?,?,?,?,?)
+        ON CONFLICT(telegram_id, plan) WHERE status='pending'
+        DO UPDATE SET created_at=excluded.created_at,
+                      order_token=COALESCE(payments.order_token, excluded.order_token)
+        RETURNING order_token
+        """,
+        (
+            telegram_id,
+            None,
+            "pending",
+            int(time.time()),
+            None,
+            None,
+            plan,
+            secrets.token_hex(8)  # hex: seguro dentro de texto Markdown
+        )
+    )
+    sub_cache.invalidate(telegram_id)
+    return res.row[0]
+
+@timed(DB_LATENCY)
+async def db_inbox_add(order_id: Optional[str], payload: dict) -> Optional[int]:
+    """
+    Grava o evento já reivindicado por esta instância (vai direto para a fila
+    dela); retorna None se esse order_id já foi recebido antes.
+    """
+    res = await db_pool.enqueue(
+        """
+        INSERT INTO webhook_inbox(order_id, payload, received_at, claimed_by, claimed_until) VALUES (?,?,?,?,?)
+        ON CONFLICT(order_id) DO NOTHING
+        """,
+        (
+            order_id,
+            json.dumps(payload, ensure_ascii=False),
+            datetime.now(timezone.utc).isoformat(),
+            INSTANCE_ID,
+            int(time.time()) + WEBHOOK_CLAIM_TTL,
+        )
+    )
+    if not res.rowcount:
+        return None
+    return res.lastrowid
+
+@timed(DB_LATENCY)
+async def db_inbox_claim():
+    """
+    Reivindica (atomicamente) os eventos não processados sem dono ou com o
+    prazo vencido (instância que caiu). Retorna [(id, payload)] em ordem.
+    """
+    now = int(time.time())
+    async with db_pool.write() as db:
+        cur = await db.execute(
             """
-            INSERT INTO payments(telegram_id, email, status, created_at, approved_at, expires_at, plan)
-            VALUES (?,?,?,?,?,?,?)
+            UPDATE webhook_inbox SET claimed_by=?, claimed_until=?
+            WHERE processed_at IS NULL AND (claimed_until IS NULL OR claimed_until < ?)
+            RETURNING id, payload
             """,
-            (
-                telegram_id,
-                None,
-                "pending",
-                datetime.now(timezone.utc).isoformat(),
-                None,
-                None,
-                plan
-            )
+            (INSTANCE_ID, now + WEBHOOK_CLAIM_TTL, now)
         )
-        await db.commit()
+        rows = await cur.fetchall()
+        await cur.close()
+    return sorted(rows)
 
-async def db_attach_email_latest(telegram_id: int, email: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # atualiza o registro mais recente pending/qualquer do usuário
-        await db.execute(
+@timed(DB_LATENCY)
+async def db_inbox_extend_claim(inbox_id: int, until: int):
+    await db_pool.enqueue(
+        "UPDATE webhook_inbox SET claimed_until=? WHERE id=? AND claimed_by=?",
+        (until, inbox_id, INSTANCE_ID)
+    )
+
+@timed(DB_LATENCY)
+async def db_inbox_done(inbox_id: int, result: str):
+    await db_pool.enqueue(
+        "UPDATE webhook_inbox SET processed_at=?, result=? WHERE id=?",
+        (datetime.now(timezone.utc).isoformat(), result, inbox_id)
+    )
+
+@timed(DB_LATENCY)
+async def db_compact_pending(retention_days: int, chunk: int = 500) -> int:
+    """
+    Apaga pedidos pendentes/abandonados mais velhos que a retenção, em lotes.
+    Pedido com order_token fica: o link de checkout continua no chat e o token
+    é o único jeito de ligar o pagamento ao usuário. Como existe no máximo um
+    pendente por (telegram_id, plan), eles não se acumulam.
+    """
+    cutoff = int(time.time()) - retention_days * 86400
+    total = 0
+    while True:
+        res = await db_pool.enqueue(
             """
-            UPDATE payments
-            SET email=?
-            WHERE id = (
+            DELETE FROM payments WHERE id IN (
               SELECT id FROM payments
-              WHERE telegram_id=?
-              ORDER BY created_at DESC
-              LIMIT 1
+              WHERE status IN ('pending', 'superseded') AND created_at < ? AND order_token IS NULL
+              LIMIT ?
             )
             """,
-            (email, telegram_id)
+            (cutoff, chunk)
         )
-        await db.commit()
+        total += res.rowcount
+        if res.rowcount < chunk:
+            return total
 
+@timed(DB_LATENCY)
+async def db_attach_email_latest(telegram_id: int, email: str):
+    # atualiza o registro mais recente pending/qualquer do usuário
+    await db_pool.enqueue(SQL_ATTACH_EMAIL, (email, telegram_id))
+    sub_cache.invalidate(telegram_id)
+    if known_emails is not None:
+        known_emails.add(email.strip().lower())
+
+@timed(DB_LATENCY)
+async def db_load_known_emails() -> BloomFilter:
+    bloom = BloomFilter(EMAIL_FILTER_CAPACITY, EMAIL_FILTER_FP_RATE)
+    async with db_pool.read() as db:
+        cur = await db.execute("SELECT DISTINCT email FROM payments WHERE email IS NOT NULL")
+        while True:
+            rows = await cur.fetchmany(1000)
+            if not rows:
+                break
+            for (email,) in rows:
+                bloom.add(email.strip().lower())
+        await cur.close()
+    return bloom
+
+@timed(DB_LATENCY)
 async def db_get_latest_by_telegram(telegram_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.read() as db:
+        cur = await db.execute(SQL_LATEST_BY_TELEGRAM, (telegram_id,))
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+@timed(DB_LATENCY)
+async def db_get_subscription_status(telegram_id: int):
+    """
+    (assinaturas, status_do_último_pedido). assinaturas = ((channel_id, plan, expires_at), ...)
+    lidas pela chave primária; o histórico só é consultado se nenhuma estiver ativa
+    (senão o status vem None).
+    """
+    found, status = sub_cache.get(telegram_id)
+    if found:
+        return status
+
+    generation = sub_cache.generation()
+    now = int(time.time())
+    async with db_pool.read() as db:
         cur = await db.execute(
-            """
-            SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
-            FROM payments
-            WHERE telegram_id=?
-            ORDER BY created_at DESC
-            LIMIT 1
-            """,
+            "SELECT channel_id, plan, expires_at FROM subscriptions WHERE telegram_id=? ORDER BY channel_id",
             (telegram_id,)
         )
+        subs = tuple(tuple(r) for r in await cur.fetchall())
+        await cur.close()
+
+        latest_status = None
+        if not any(exp is None or exp > now for _ch, _plan, exp in subs):
+            cur = await db.execute(SQL_LATEST_BY_TELEGRAM, (telegram_id,))
+            latest = await cur.fetchone()
+            await cur.close()
+            latest_status = latest[3] if latest else None
+
+    status = (subs, latest_status)
+    sub_cache.set(telegram_id, status, generation)
+    return status
+
+@timed(DB_LATENCY)
+async def db_get_by_order_token(order_token: str):
+    async with db_pool.read() as db:
+        cur = await db.execute(SQL_BY_ORDER_TOKEN, (order_token,))
         row = await cur.fetchone()
         await cur.close()
         return row
 
-async def db_get_latest_by_email(email: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+@timed(DB_LATENCY)
+async def db_get_latest_by_email(email: str, plan: Optional[str] = None):
+    async with db_pool.read() as db:
+        if plan is None:
+            cur = await db.execute(SQL_LATEST_BY_EMAIL, (email,))
+        else:
+            cur = await db.execute(SQL_LATEST_BY_EMAIL_PLAN, (email, plan))
+        row = await cur.fetchone()
+        await cur.close()
+        return row
+
+@timed(DB_LATENCY)
+async def db_mark_approved(
+    row_id: int,
+    product: "Product",
+    telegram_id: int,
+    email: Optional[str] = None,
+    order_id: Optional[str] = None,
+) -> bool:
+    """
+    Aprova o pedido como `product` (o que a Kiwify confirmou) e estende a assinatura do canal dele.
+    Se o pedido já estava aprovado e `order_id` é um pedido Kiwify novo (pagamento pelo mesmo
+    link), grava um pagamento aprovado novo. Retorna False se nada foi creditado (reentrega).
+    """
+    now = int(time.time())
+    duration = None if product.duration_days is None else product.duration_days * 86400
+
+    async with db_pool.write() as db:
+        # guarda o email do checkout se o pedido não tinha (fluxo sem a etapa de email)
         cur = await db.execute(
             """
-            SELECT id, telegram_id, email, status, created_at, approved_at, expires_at, plan
-            FROM payments
-            WHERE email=?
-            ORDER BY created_at DESC
-            LIMIT 1
+            UPDATE payments SET status='approved', approved_at=?, plan=?, email=COALESCE(email, ?), kiwify_order_id=?
+            WHERE id=? AND status!='approved'
+            """,
+            (now, product.code, email or None, order_id, row_id)
+        )
+        approved = cur.rowcount
+        await cur.close()
+        if not approved:
+            if order_id is None:
+                return False
+            # o índice único em kiwify_order_id barra a reentrega do mesmo pedido
+            cur = await db.execute(
+                """
+                INSERT INTO payments(telegram_id, email, status, created_at, approved_at, plan, kiwify_order_id)
+                VALUES (?,?,'approved',?,?,?,?)
+                ON CONFLICT(kiwify_order_id) WHERE kiwify_order_id IS NOT NULL DO NOTHING
+                """,
+                (telegram_id, email or None, now, now, product.code, order_id)
+            )
+            if not cur.rowcount:
+                await cur.close()
+                return False
+            row_id = cur.lastrowid
+            await cur.close()
+
+        # renovação empilha sobre o vencimento atual; vitalícia vence tudo
+        await db.execute(
+            """
+            INSERT INTO subscriptions(telegram_id, channel_id, plan, expires_at, payment_id, updated_at)
+            VALUES (:tg, :channel, :plan, :now + :duration, :payment, :now)
+            ON CONFLICT(telegram_id, channel_id) DO UPDATE SET
+              plan = CASE WHEN subscriptions.expires_at IS NULL THEN subscriptions.plan ELSE excluded.plan END,
+              expires_at = CASE
+                WHEN subscriptions.expires_at IS NULL OR :duration IS NULL THEN NULL
+                ELSE MAX(subscriptions.expires_at, :now) + :duration
+              END,
+              payment_id = excluded.payment_id,
+              updated_at = excluded.updated_at
             """,
-            (email,)
+            {"tg": telegram_id, "channel": product.channel_id, "plan": product.code,
+             "now": now, "duration": duration, "payment": row_id}
         )
+        cur = await db.execute(
+            "SELECT expires_at FROM subscriptions WHERE telegram_id=? AND channel_id=?",
+            (telegram_id, product.channel_id)
+        )
+        (expires,) = await cur.fetchone()
+        await cur.close()
+        await db.execute("UPDATE payments SET expires_at=? WHERE id=?", (expires, row_id))
+
+    sub_cache.invalidate(telegram_id)
+    if expires:
+        event_scheduler.track_expiry(expires)
+    return True
+
+
+@timed(DB_LATENCY)
+async def db_job_get(name: str):
+    async with db_pool.read() as db:
+        cur = await db.execute("SELECT value FROM job_state WHERE name=?", (name,))
         row = await cur.fetchone()
         await cur.close()
-        return row
+    return json.loads(row[0]) if row else None
+
+@timed(DB_LATENCY)
+async def db_job_set(name: str, value):
+    await db_pool.enqueue(
+        """
+        INSERT INTO job_state(name, value, updated_at) VALUES (?,?,?)
+        ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+        """,
+        (name, json.dumps(value), datetime.now(timezone.utc).isoformat())
+    )
 
-async def db_mark_approved(row_id: int, plan: str):
-    now = datetime.now(timezone.utc)
-    if plan == "life":
-        expires = None
-    else:
-        expires = now + timedelta(days=SUB_DAYS)
+@timed(DB_LATENCY)
+async def db_job_lease(name: str, seconds: int) -> bool:
+    """Pega (ou renova) o lease do job para esta instância; False se outra o tem."""
+    now = int(time.time())
+    res = await db_pool.enqueue(
+        """
+        INSERT INTO job_state(name, value, updated_at) VALUES (?,?,?)
+        ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+        WHERE json_extract(job_state.value, '$[0]') = ? OR json_extract(job_state.value, '$[1]') <= ?
+        """,
+        (f"{name}.lease", json.dumps([INSTANCE_ID, now + seconds]),
+         datetime.now(timezone.utc).isoformat(), INSTANCE_ID, now)
+    )
+    return bool(res.rowcount)
+
+@timed(DB_LATENCY)
+async def db_job_release(name: str):
+    await db_pool.enqueue(
+        "UPDATE job_state SET value=json_array(?, 0) WHERE name=? AND json_extract(value, '$[0]') = ?",
+        (INSTANCE_ID, f"{name}.lease", INSTANCE_ID)
+    )
+
+@asynccontextmanager
+async def job_lease(name: str):
+    """Só uma réplica roda o job por vez; as outras recebem False."""
+    leased = await db_job_lease(name, JOB_LEASE_TTL)
+    try:
+        yield leased
+    finally:
+        if leased:
+            await db_job_release(name)
+
+@timed(DB_LATENCY)
+async def db_expiring_after(after, until: int, limit: int):
+    """
+    Assinaturas (telegram_id, channel_id, expires_at) com vencimento depois do
+    cursor after = (expires_at, telegram_id, channel_id) e até `until`.
+    """
+    async with db_pool.read() as db:
+        cur = await db.execute(
+            """
+            SELECT telegram_id, channel_id, expires_at FROM subscriptions
+            WHERE expires_at IS NOT NULL
+              AND (expires_at, telegram_id, channel_id) > (?, ?, ?) AND expires_at <= ?
+            ORDER BY expires_at, telegram_id, channel_id
+            LIMIT ?
+            """,
+            (*after, until, limit)
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+@timed(DB_LATENCY)
+async def db_next_expirations(after: int, limit: int):
+    """Próximos expires_at distintos depois de `after` (janela do agendador)."""
+    async with db_pool.read() as db:
+        cur = await db.execute(
+            """
+            SELECT DISTINCT expires_at FROM subscriptions
+            WHERE expires_at IS NOT NULL AND expires_at > ?
+            ORDER BY expires_at
+            LIMIT ?
+            """,
+            (after, limit)
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return [r[0] for r in rows]
+
+@timed(DB_LATENCY)
+async def db_has_active_subscription(telegram_id: int, channel_id: int, now: int) -> bool:
+    # renovou (ou tem vitalícia) => não remove do canal
+    async with db_pool.read() as db:
+        cur = await db.execute(
+            "SELECT 1 FROM subscriptions "
+            "WHERE telegram_id=? AND channel_id=? AND (expires_at IS NULL OR expires_at > ?)",
+            (telegram_id, channel_id, now)
+        )
+        row = await cur.fetchone()
+        await cur.close()
+    return row is not None
+
+@timed(DB_LATENCY)
+async def db_fsm_evict(ttl: int) -> int:
+    res = await db_pool.enqueue(
+        "DELETE FROM fsm_state WHERE updated_at < ?",
+        (int(time.time()) - ttl,)
+    )
+    return res.rowcount
+
+
+# =========================
+# Catálogo (canais e planos)
+# =========================
+class Product(NamedTuple):
+    code: str  # vai em payments.plan / subscriptions.plan e no callback buy:<code>
+    channel_id: int
+    label: str
+    price: float
+    duration_days: Optional[int]  # None = vitalício
+    checkout_url: str
+    kiwify_product_id: Optional[str]
+    active: bool
+
+
+# botões antigos (mensagens já enviadas) continuam funcionando
+LEGACY_BUY_CALLBACKS = {"buy_30": "30d", "buy_life": "life"}
+
+
+class Catalog:
+    """
+    Índice imutável do catálogo. Recarregar monta outro e troca a referência
+    global de uma vez; quem está no meio de um handler segue com o antigo.
+    """
+
+    def __init__(self, version: int, channels: Dict[int, Tuple[str, bool]], products):
+        self.version = version
+        self.channels = channels  # channel_id -> (nome, ativo)
+        self.products = {p.code: p for p in products}
+        self.by_kiwify = {p.kiwify_product_id: p for p in products if p.kiwify_product_id}
+        # à venda: plano e canal ativos, na ordem de exibição
+        self.for_sale = [p for p in products if p.active and channels.get(p.channel_id, ("", False))[1]]
+        self.channels_for_sale = list(dict.fromkeys(p.channel_id for p in self.for_sale))
+
+    def channel_name(self, channel_id: int) -> str:
+        return self.channels.get(channel_id, (PRODUCT_NAME, False))[0]
+
+    def title(self) -> str:
+        return " / ".join(self.channel_name(ch) for ch in self.channels_for_sale) or PRODUCT_NAME
+
+
+catalog = Catalog(0, {}, [])
+
+
+@timed(DB_LATENCY)
+async def db_catalog_version() -> int:
+    async with db_pool.read() as db:
+        cur = await db.execute("SELECT version FROM catalog_version WHERE id=1")
+        (version,) = await cur.fetchone()
+        await cur.close()
+    return version
+
+@timed(DB_LATENCY)
+async def db_load_catalog() -> Catalog:
+    async with db_pool.read() as db:
+        # versão lida antes: se mudar no meio, o próximo poll recarrega de novo
+        cur = await db.execute("SELECT version FROM catalog_version WHERE id=1")
+        (version,) = await cur.fetchone()
+        await cur.close()
+        cur = await db.execute("SELECT id, name, active FROM channels")
+        channels = {r[0]: (r[1], bool(r[2])) for r in await cur.fetchall()}
+        await cur.close()
+        cur = await db.execute(
+            """
+            SELECT code, channel_id, label, price, duration_days, checkout_url, kiwify_product_id, active
+            FROM products ORDER BY position, code
+            """
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+
+    products = []
+    for r in rows:
+        product = Product(*r[:7], bool(r[7]))
+        if len(f"buy:{product.code}".encode()) > 64:
+            log.warning("plano %r ignorado: código grande demais para callback_data", product.code)
+            continue
+        products.append(product)
+    return Catalog(version, channels, products)
+
+CATALOG_ENV_FIELDS = ("label", "price", "duration_days", "checkout_url", "kiwify_product_id")
+
+def catalog_env() -> dict:
+    """Planos 30d/life e nome do canal como o env descreve."""
+    return {
+        "name": PRODUCT_NAME,
+        "30d": [f"{SUB_DAYS} dias", PRICE_30, SUB_DAYS, KIWIFY_LINK_30, KIWIFY_PRODUCT_30 or None],
+        "life": ["Vitalícia", PRICE_LIFE, None, KIWIFY_LINK_LIFE, KIWIFY_PRODUCT_LIFE or None],
+    }
+
+async def db_seed_catalog():
+    """
+    Instalação de canal único: cria o canal/planos do env se o catálogo está
+    vazio, e adota o CHANNEL_ID quando ele for configurado depois (canal 0).
+    Se o env mudou desde a última aplicação (job_state "catalog_env"), leva os
+    valores novos para os planos 30d/life; edições feitas pelo /admin/import
+    ficam enquanto o env não mudar.
+    """
+    channel_id = int(CHANNEL_ID) if CHANNEL_ID else 0
+    env = catalog_env()
+    async with db_pool.write() as db:
+        if channel_id:
+            cur = await db.execute("SELECT 1 FROM channels WHERE id=0")
+            placeholder = await cur.fetchone()
+            await cur.close()
+            if placeholder:
+                await db.execute("UPDATE channels SET id=? WHERE id=0", (channel_id,))
+                await db.execute("UPDATE products SET channel_id=? WHERE channel_id=0", (channel_id,))
+                await db.execute("UPDATE subscriptions SET channel_id=? WHERE channel_id=0", (channel_id,))
+
+        cur = await db.execute("SELECT COUNT(*) FROM products")
+        (count,) = await cur.fetchone()
+        await cur.close()
+        if not count:
+            await db.execute("INSERT OR IGNORE INTO channels(id, name) VALUES (?, ?)", (channel_id, PRODUCT_NAME))
+            await db.executemany(
+                """
+                INSERT INTO products(code, channel_id, label, price, duration_days, checkout_url, kiwify_product_id, position)
+                VALUES (?,?,?,?,?,?,?,?)
+                """,
+                [
+                    ("30d", channel_id, *env["30d"], 0),
+                    ("life", channel_id, *env["life"], 1),
+                ]
+            )
+            log.info("catálogo criado a partir do env (canal %s)", channel_id)
+        else:
+            await _db_sync_catalog_env(db, channel_id, env)
 
-    async with aiosqlite.connect(DB_PATH) as db:
         await db.execute(
             """
-            UPDATE payments
-            SET status=?, approved_at=?, expires_at=?
-            WHERE id=?
+            INSERT INTO job_state(name, value, updated_at) VALUES ('catalog_env', ?, ?)
+            ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
             """,
-            (
-                "approved",
-                now.isoformat(),
-                (expires.isoformat() if expires else None),
-                row_id
+            (json.dumps(env), datetime.now(timezone.utc).isoformat())
+        )
+
+async def _db_sync_catalog_env(db, channel_id: int, env: dict):
+    cur = await db.execute("SELECT value FROM job_state WHERE name='catalog_env'")
+    row = await cur.fetchone()
+    await cur.close()
+    applied = json.loads(row[0]) if row else None
+    if applied == env:
+        return
+
+    cur = await db.execute(
+        f"SELECT code, {', '.join(CATALOG_ENV_FIELDS)} FROM products WHERE code IN ('30d', 'life')"
+    )
+    current = {code: list(values) for code, *values in await cur.fetchall()}
+    await cur.close()
+
+    if applied is None:
+        # catálogo criado antes de guardarmos o env aplicado: não dá para saber
+        # se a diferença é do env ou de edição no DB, então só avisa
+        for code in ("30d", "life"):
+            if code in current and current[code] != env[code]:
+                diff = [
+                    f"{field}: catálogo={old!r} env={new!r}"
+                    for field, old, new in zip(CATALOG_ENV_FIELDS, current[code], env[code])
+                    if old != new
+                ]
+                log.warning(
+                    "plano %s no catálogo difere do env (vale o catálogo; a próxima mudança no env é aplicada): %s",
+                    code, "; ".join(diff)
+                )
+        return
+
+    for code in ("30d", "life"):
+        if code not in current or applied.get(code) == env[code]:
+            continue
+        try:
+            await db.execute(
+                f"UPDATE products SET {', '.join(f + '=?' for f in CATALOG_ENV_FIELDS)} WHERE code=?",
+                (*env[code], code)
             )
+        except sqlite3.IntegrityError:
+            # kiwify_product_id já usado por outro produto do catálogo
+            log.error("env do plano %s não aplicado: KIWIFY_PRODUCT_* já pertence a outro produto", code)
+            continue
+        log.info("plano %s atualizado a partir do env", code)
+    if applied.get("name") != env["name"] and channel_id:
+        await db.execute("UPDATE channels SET name=? WHERE id=?", (env["name"], channel_id))
+
+async def catalog_reload():
+    global catalog
+    catalog = await db_load_catalog()
+
+
+# =========================
+# Telegram: FSM storage
+# =========================
+class SQLiteStorage(BaseStorage):
+    """
+    FSM no mesmo arquivo SQLite: sobrevive a redeploy e é compartilhado entre
+    workers. Estados parados há mais de ttl segundos contam como vazios e
+    são apagados pelo job de manutenção.
+    """
+
+    def __init__(self, pool: DBPool, ttl: int):
+        self.pool = pool
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _get(self, key: StorageKey):
+        async with self.pool.read() as db:
+            cur = await db.execute(
+                "SELECT state, data FROM fsm_state WHERE key=? AND updated_at >= ?",
+                (self._key(key), int(time.time()) - self.ttl)
+            )
+            row = await cur.fetchone()
+            await cur.close()
+        return row
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self.pool.enqueue(
+            """
+            INSERT INTO fsm_state(key, state, updated_at) VALUES (?,?,?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at
+            """,
+            (self._key(key), state, int(time.time()))
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._get(key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.pool.enqueue(
+            """
+            INSERT INTO fsm_state(key, data, updated_at) VALUES (?,?,?)
+            ON CONFLICT(key) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at
+            """,
+            (self._key(key), json.dumps(data, ensure_ascii=False), int(time.time()))
         )
-        await db.commit()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._get(key)
+        return json.loads(row[1]) if row else {}
+
+    async def close(self) -> None:
+        # conexões são do db_pool, fechadas no shutdown do app
+        pass
+
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        # qualquer servidor que fale o protocolo Redis serve (redis, valkey, keydb...)
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise RuntimeError("FSM_STORAGE=redis requer o pacote 'redis' (pip install redis)")
+        return RedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(db_pool, FSM_STATE_TTL)
+    raise RuntimeError("FSM_STORAGE deve ser 'sqlite', 'redis' ou 'memory'")
+
+
+dp = Dispatcher(storage=make_fsm_storage())
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
 
 
 # =========================
 # Helpers
 # =========================
+def checkout_link(url: str, order_token: str) -> str:
+    """Link da Kiwify com o token do pedido em ?src= (volta em TrackingParameters.src)."""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != "src"]
+    query.append(("src", order_token))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
 def is_valid_email(email: str) -> bool:
     email = email.strip()
     return bool(re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", email))
@@ -200,18 +1990,98 @@ class BuyFlow(StatesGroup):
     waiting_email = State()
 
 
-def kb_main():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"💳 Assinar 30 dias (R$ {PRICE_30:.2f})", callback_data="buy_30")],
-        [InlineKeyboardButton(text=f"💎 Vitalícia (R$ {PRICE_LIFE:.2f})", callback_data="buy_life")],
-        [InlineKeyboardButton(text="📌 Minha assinatura", callback_data="my_sub")],
-        [InlineKeyboardButton(text="📞 Suporte", callback_data="support")],
-    ])
+# =========================
+# Telegram: textos e teclados
+# =========================
+def product_button_text(product: Product) -> str:
+    if product.duration_days is None:
+        return f"💎 {product.label} (R$ {product.price:.2f})"
+    return f"💳 Assinar {product.label} (R$ {product.price:.2f})"
+
+def _build_kb_main(cat: Catalog) -> InlineKeyboardMarkup:
+    # com mais de um canal à venda o botão diz de qual canal é o plano
+    multi = len(cat.channels_for_sale) > 1
+    rows = []
+    for product in cat.for_sale:
+        text = product_button_text(product)
+        if multi:
+            text = f"{cat.channel_name(product.channel_id)} · {text}"
+        rows.append([InlineKeyboardButton(text=text, callback_data=f"buy:{product.code}")])
+    rows.append([InlineKeyboardButton(text="📌 Minha assinatura", callback_data="my_sub")])
+    rows.append([InlineKeyboardButton(text="📞 Suporte", callback_data="support")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def _build_plan_lines(cat: Catalog) -> str:
+    multi = len(cat.channels_for_sale) > 1
+    lines = []
+    for channel_id in cat.channels_for_sale:
+        if multi:
+            lines.append(f"📢 *{cat.channel_name(channel_id)}*")
+        for product in cat.for_sale:
+            if product.channel_id != channel_id:
+                continue
+            if product.duration_days is None:
+                lines.append(f"♾ *Acesso vitalício* — R$ {product.price:.2f}")
+            else:
+                lines.append(f"🗓 *{product.duration_days} dias de acesso* — R$ {product.price:.2f}")
+        if multi:
+            lines.append("")
+    return "\n".join(lines).rstrip("\n")
+
+
+class Templates:
+    """
+    Teclados e textos do funil, montados uma vez por versão do catálogo
+    (preço/nome mudou => versão nova => remonta). Os objetos são
+    compartilhados entre updates: não altere depois de prontos.
+    """
+
+    def __init__(self, cat: Catalog):
+        self.version = cat.version
+        self.kb_main = _build_kb_main(cat)
+        self.kb_back = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ Voltar", callback_data="back")]
+        ])
+        self.start_text = (
+            f"🚀 *Bem-vindo ao acesso VIP!*\n\n"
+            f"Aqui você entra para o *{cat.title()}* e recebe:\n"
+            f"✅ Conteúdo exclusivo\n"
+            f"✅ Atualizações frequentes\n"
+            f"✅ Acesso imediato após o pagamento\n\n"
+            f"💳 *Escolha seu plano abaixo:*"
+        )
+        self.plans_text = (
+            f"💎 *PLANOS DISPONÍVEIS*\n\n"
+            f"{_build_plan_lines(cat)}\n\n"
+            f"Pagamento via Kiwify com liberação automática 🔓"
+        )
+        # só planos à venda: código fora daqui = plano indisponível.
+        # (antes, depois) do link de checkout, que leva o token do pedido
+        self.choose_text = {
+            product.code: (
+                f"🛒 Você escolheu: *{product.label}*\n\n"
+                "✅ Finalize o pagamento no link abaixo:\n"
+                "🔗 ",
+                "\n\n"
+                "Assim que a Kiwify confirmar o pagamento, eu libero seu acesso automaticamente. 🚀"
+            )
+            for product in cat.for_sale
+        }
+
 
-def kb_back():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Voltar", callback_data="back")]
-    ])
+_templates: Optional[Templates] = None
+
+def templates() -> Templates:
+    global _templates
+    if _templates is None or _templates.version != catalog.version:
+        _templates = Templates(catalog)
+    return _templates
+
+def kb_main() -> InlineKeyboardMarkup:
+    return templates().kb_main
+
+def kb_back() -> InlineKeyboardMarkup:
+    return templates().kb_back
 
 
 # =========================
@@ -219,27 +2089,13 @@ def kb_back():
 # =========================
 @dp.message(Command("start"))
 async def cmd_start(msg: Message):
-    await msg.answer(
-        f"🚀 *Bem-vindo ao acesso VIP!*\n\n"
-        f"Aqui você entra para o *{PRODUCT_NAME}* e recebe:\n"
-        f"✅ Conteúdo exclusivo\n"
-        f"✅ Atualizações frequentes\n"
-        f"✅ Acesso imediato após o pagamento\n\n"
-        f"💳 *Escolha seu plano abaixo:*",
-        parse_mode="Markdown",
-        reply_markup=kb_main()
-    )
+    t = templates()
+    await msg.answer(t.start_text, parse_mode="Markdown", reply_markup=t.kb_main)
 
 @dp.message(Command("planos"))
 async def cmd_planos(msg: Message):
-    await msg.answer(
-        f"💎 *PLANOS DISPONÍVEIS*\n\n"
-        f"🗓 *30 dias de acesso* — R$ {PRICE_30:.2f}\n"
-        f"♾ *Acesso vitalício* — R$ {PRICE_LIFE:.2f}\n\n"
-        f"Pagamento via Kiwify com liberação automática 🔓",
-        parse_mode="Markdown",
-        reply_markup=kb_main()
-    )
+    t = templates()
+    await msg.answer(t.plans_text, parse_mode="Markdown", reply_markup=t.kb_main)
 
 @dp.message(Command("get_channel_id"))
 async def cmd_get_channel_id(msg: Message):
@@ -281,28 +2137,34 @@ async def cb_back(c: CallbackQuery):
     )
     await c.answer()
 
-@dp.callback_query(F.data.in_(["buy_30", "buy_life"]))
+@dp.callback_query(F.data.startswith("buy:") | F.data.in_(LEGACY_BUY_CALLBACKS))
 async def cb_choose_plan(c: CallbackQuery, state: FSMContext):
-    plan = "30d" if c.data == "buy_30" else "life"
-    label = "30 dias" if plan == "30d" else "Vitalícia"
-    link = KIWIFY_LINK_30 if plan == "30d" else KIWIFY_LINK_LIFE
-
-    # cria um "pedido pendente" no DB
-    await db_create_pending(c.from_user.id, plan)
+    code = LEGACY_BUY_CALLBACKS.get(c.data) or c.data.split(":", 1)[1]
+    t = templates()
+    text = t.choose_text.get(code)
+    if text is None:
+        await c.answer("Esse plano não está mais disponível. Use /planos.", show_alert=True)
+        return
+    product = catalog.products[code]
 
-    # pede email para casar com o pagamento do webhook
-    await state.update_data(plan=plan, link=link, label=label)
-    await state.set_state(BuyFlow.waiting_email)
+    # cria um "pedido pendente" no DB; o token dele vai no link e volta no webhook.
+    # O estado é só lido (junto): quase ninguém tem etapa de email aberta
+    order_token, fsm_state = await asyncio.gather(
+        db_create_pending(c.from_user.id, product.code), state.get_state()
+    )
+    # sai de uma etapa de email antiga que tenha ficado aberta
+    if fsm_state is not None:
+        await state.clear()
 
+    head, tail = text
     await c.message.answer(
-        f"🛒 Você escolheu: *{label}*\n\n"
-        "✅ Para eu liberar automaticamente, me envie o *mesmo e-mail* que você vai usar no checkout da Kiwify.\n\n"
-        "Exemplo: nome@gmail.com",
+        head + checkout_link(product.checkout_url, order_token) + tail,
         parse_mode="Markdown",
-        reply_markup=kb_back()
+        reply_markup=t.kb_back
     )
     await c.answer()
 
+# conversas que pararam na antiga etapa de email (antes do token no link)
 @dp.message(BuyFlow.waiting_email)
 async def on_email(msg: Message, state: FSMContext):
     email = (msg.text or "").strip()
@@ -330,16 +2192,11 @@ async def on_email(msg: Message, state: FSMContext):
 @dp.callback_query(F.data == "my_sub")
 async def cb_my_sub(c: CallbackQuery):
     telegram_id = c.from_user.id
-    row = await db_get_latest_by_telegram(telegram_id)
-
-    if not row:
-        await c.message.answer("Você ainda não tem assinatura. Clique em 💳 Assinar para gerar o pagamento.")
-        await c.answer()
-        return
-
-    _id, tg_id, email, status, created_at, approved_at, expires_at, plan = row
+    subs, latest_status = await db_get_subscription_status(telegram_id)
+    now = datetime.now(timezone.utc)
+    active_any = any(exp is None or exp > now.timestamp() for _ch, _plan, exp in subs)
 
-    if status != "approved":
+    if not active_any and latest_status not in (None, "approved"):
         await c.message.answer(
             "⏳ Encontrei um pedido seu, mas a assinatura ainda não está ativa.\n"
             "Se você já pagou, aguarde alguns instantes e tente novamente."
@@ -347,86 +2204,436 @@ async def cb_my_sub(c: CallbackQuery):
         await c.answer()
         return
 
-    if plan == "life":
+    if not subs and latest_status == "approved":
+        # aprovado sem assinatura: pedido antigo sem data de expiração (ver _m008)
         await c.message.answer(
-            "💎 Sua assinatura é *VITALÍCIA*.\n"
-            "Vou gerar um link novo pra você entrar 👇",
-            parse_mode="Markdown"
+            "⚠️ Sua assinatura consta como aprovada, mas não encontrei a data de expiração.\n"
+            "Fale com o suporte."
         )
-        await grant_access(telegram_id)
         await c.answer()
         return
 
-    if not expires_at:
-        await c.message.answer(
-            "⚠️ Sua assinatura consta como aprovada, mas não encontrei a data de expiração.\n"
-            "Fale com o suporte."
-        )
+    if not subs:
+        await c.message.answer("Você ainda não tem assinatura. Clique em 💳 Assinar para gerar o pagamento.")
         await c.answer()
         return
 
-    exp = datetime.fromisoformat(expires_at)
-    now = datetime.now(timezone.utc)
+    # uma assinatura por canal; o nome do canal só aparece se houver mais de um
+    multi = len(subs) > 1 or len(catalog.channels_for_sale) > 1
+    for channel_id, plan, expires_at in subs:
+        channel = f" de *{catalog.channel_name(channel_id)}*" if multi else ""
 
-    if now < exp:
-        restante = exp - now
-        dias = max(restante.days, 0)
-        await c.message.answer(
-            f"✅ Assinatura *ativa*\n"
-            f"📅 Expira em: *{exp.astimezone().strftime('%d/%m/%Y %H:%M')}*\n"
-            f"⏳ Restam: *{dias} dia(s)*\n\n"
-            "Vou gerar um link novo pra você entrar 👇",
-            parse_mode="Markdown"
+        if expires_at is None:
+            await c.message.answer(
+                f"💎 Sua assinatura{channel} é *VITALÍCIA*.\n"
+                "Vou gerar um link novo pra você entrar 👇",
+                parse_mode="Markdown"
+            )
+            await grant_access(telegram_id, channel_id)
+            continue
+
+        exp = datetime.fromtimestamp(expires_at, timezone.utc)
+
+        if exp > now:
+            restante = exp - now
+            dias = max(restante.days, 0)
+            await c.message.answer(
+                f"✅ Assinatura{channel} *ativa*\n"
+                f"📅 Expira em: *{exp.astimezone().strftime('%d/%m/%Y %H:%M')}*\n"
+                f"⏳ Restam: *{dias} dia(s)*\n\n"
+                "Vou gerar um link novo pra você entrar 👇",
+                parse_mode="Markdown"
+            )
+            await grant_access(telegram_id, channel_id)
+        else:
+            await c.message.answer(
+                f"❌ Assinatura{channel} *expirada*\n"
+                f"📅 Expirou em: *{exp.astimezone().strftime('%d/%m/%Y %H:%M')}*\n\n"
+                "Use /planos para renovar.",
+                parse_mode="Markdown"
+            )
+
+    await c.answer()
+
+
+# =========================
+# Telegram: pool de links de convite
+# =========================
+class InviteLinkPool:
+    """
+    Links de 1 uso pré-gerados para um canal. O hot path só faz pop() em memória;
+    um job em background repõe quando cai abaixo do low watermark e descarta
+    os que estão perto de expirar.
+    """
+
+    def __init__(self, chat_id: int, size: int, low: int, ttl: timedelta, min_remaining: timedelta):
+        self.chat_id = chat_id
+        self.size = size
+        self.low = min(low, size)
+        self.ttl = ttl
+        self.min_remaining = min_remaining
+        # criados em ordem e com o mesmo TTL => ordenados por expiração
+        self.links = deque()
+        self._refill = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "misses": 0, "created": 0, "evicted": 0}
+
+    async def _create(self) -> Tuple[str, datetime]:
+        expire = datetime.now(timezone.utc) + self.ttl
+        invite = await bot.create_chat_invite_link(
+            chat_id=self.chat_id,
+            member_limit=1,
+            expire_date=expire
         )
-        await grant_access(telegram_id)
-    else:
-        await c.message.answer(
-            f"❌ Assinatura *expirada*\n"
-            f"📅 Expirou em: *{exp.astimezone().strftime('%d/%m/%Y %H:%M')}*\n\n"
-            "Clique em 💳 Assinar 30 dias ou 💎 Vitalícia para renovar.",
-            parse_mode="Markdown"
+        self.stats["created"] += 1
+        return invite.invite_link, expire
+
+    def evict_expired(self) -> int:
+        limit = datetime.now(timezone.utc) + self.min_remaining
+        evicted = 0
+        while self.links and self.links[0][1] <= limit:
+            self.links.popleft()
+            evicted += 1
+        self.stats["evicted"] += evicted
+        return evicted
+
+    async def pop(self) -> Tuple[str, datetime]:
+        self.start()  # canal novo no catálogo: o pool sobe no primeiro uso
+        self.evict_expired()
+        if len(self.links) <= self.low:
+            self.wake()
+        if self.links:
+            self.stats["hits"] += 1
+            return self.links.popleft()
+        # pool vazio: cria na hora (com a prioridade de quem chamou)
+        self.stats["misses"] += 1
+        return await self._create()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def _refill_loop(self):
+        while True:
+            self.evict_expired()
+            try:
+                with priority(PRIORITY_BACKGROUND):
+                    while len(self.links) < self.size:
+                        self.links.append(await self._create())
+            except Exception:
+                log.exception("falha pré-gerando links do canal %s", self.chat_id)
+                await asyncio.sleep(30)
+                continue
+
+            # dorme até alguém consumir abaixo do watermark ou o evento
+            # "invite_cleanup" do agendador (hora em que o mais velho vence)
+            self._refill.clear()
+            if self.links:
+                event_scheduler.schedule(
+                    (self.links[0][1] - self.min_remaining).timestamp(), "invite_cleanup"
+                )
+            await self._refill.wait()
+
+    def wake(self):
+        self._refill.set()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # revoga os que sobraram para não ficarem links válidos soltos
+        with priority(PRIORITY_BACKGROUND):
+            while self.links:
+                link, _expire = self.links.popleft()
+                try:
+                    await bot.revoke_chat_invite_link(chat_id=self.chat_id, invite_link=link)
+                except Exception:
+                    log.warning("não consegui revogar link do canal %s", self.chat_id)
+
+
+invite_pools = {}
+
+def invite_pool(chat_id: int) -> InviteLinkPool:
+    pool = invite_pools.get(chat_id)
+    if pool is None:
+        pool = invite_pools[chat_id] = InviteLinkPool(
+            chat_id,
+            INVITE_POOL_SIZE,
+            INVITE_POOL_LOW,
+            timedelta(minutes=INVITE_LINK_TTL_MIN),
+            timedelta(minutes=INVITE_MIN_REMAINING_MIN),
         )
+    return pool
 
-    await c.answer()
+def start_invite_pools():
+    """Pré-aquece o pool de cada canal ativo do catálogo."""
+    for channel_id, (_name, active) in catalog.channels.items():
+        if channel_id and active:
+            invite_pool(channel_id).start()
 
 
 # =========================
 # Telegram: liberar acesso
 # =========================
-async def grant_access(telegram_id: int):
-    if not CHANNEL_ID:
+async def grant_access(telegram_id: int, channel_id: int):
+    if not channel_id:
         await bot.send_message(
             telegram_id,
             "⚠️ Pagamento aprovado, mas o administrador ainda não configurou o CHANNEL_ID do canal."
         )
         return
 
-    expire = datetime.now(timezone.utc) + timedelta(minutes=10)
+    with priority(PRIORITY_ACCESS):
+        try:
+            link, expire = await invite_pool(channel_id).pop()
+        except (TelegramBadRequest, TelegramForbiddenError):
+            log.exception("create_chat_invite_link recusado no canal %s", channel_id)
+            await bot.send_message(
+                telegram_id,
+                "⚠️ Não consegui criar o link.\n"
+                "Verifique se o bot é ADMIN do canal e tem permissão de convidar usuários."
+            )
+            return
+        except Exception:
+            # 429 persistente, 5xx, rede: não é problema de permissão
+            log.exception("falha temporária criando link para %s", telegram_id)
+            await bot.send_message(
+                telegram_id,
+                "⚠️ Tive um problema temporário para gerar seu link.\n"
+                "Clique em 📌 Minha assinatura em alguns instantes para tentar de novo."
+            )
+            return
 
-    try:
-        invite = await bot.create_chat_invite_link(
-            chat_id=int(CHANNEL_ID),
-            member_limit=1,
-            expire_date=expire
-        )
+        minutes = max(round((expire - datetime.now(timezone.utc)).total_seconds() / 60), 1)
         await bot.send_message(
             telegram_id,
-            "✅ Aqui está seu link de acesso (1 uso / expira em 10 min):\n"
-            f"{invite.invite_link}\n\n"
+            f"✅ Aqui está seu link de acesso (1 uso / expira em {minutes} min):\n"
+            f"{link}\n\n"
             "Se expirar, clique em 📌 Minha assinatura para gerar outro.",
         )
+
+
+# =========================
+# Telegram: remover assinaturas vencidas
+# =========================
+async def kick_member(chat_id: int, telegram_id: int):
+    # ban + unban = remove do canal, mas deixa entrar de novo se renovar
+    await bot.ban_chat_member(chat_id=chat_id, user_id=telegram_id)
+    await bot.unban_chat_member(chat_id=chat_id, user_id=telegram_id, only_if_banned=True)
+
+async def _expire_one(chat_id: int, telegram_id: int, now: int) -> bool:
+    """False se falhou de um jeito que vale tentar de novo depois."""
+    if not chat_id or await db_has_active_subscription(telegram_id, chat_id, now):
+        return True
+    try:
+        await kick_member(chat_id, telegram_id)
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        # não está no canal, é admin etc.: nada a fazer
+        log.info("não removi %s do canal: %s", telegram_id, e)
     except Exception:
+        log.exception("falha removendo %s do canal", telegram_id)
+        return False
+    return True
+
+_sweep_lock = asyncio.Lock()
+_remind_lock = asyncio.Lock()
+
+async def sweep_expired() -> int:
+    """
+    Remove dos canais quem venceu desde o último checkpoint (job_state).
+    Cada lote só avança o checkpoint se todas as remoções deram certo.
+    Com várias réplicas só a que tem o lease varre; as outras tentam de novo
+    daqui a pouco (o checkpoint já terá avançado).
+    """
+    async with _sweep_lock:
+        async with job_lease("expiry_sweep") as leased:
+            if not leased:
+                event_scheduler.schedule(time.time() + JOB_LEASE_RETRY, "expire")
+                return 0
+            return await _sweep_expired()
+
+async def _sweep_expired() -> int:
+    # cursor = (expires_at, telegram_id, channel_id) da última assinatura processada
+    cursor = await db_job_get("expiry_sweep") or [0, 0, 0]
+    now = int(time.time())
+    done = 0
+
+    with priority(PRIORITY_BACKGROUND):
+        while True:
+            rows = await db_expiring_after(cursor, now, EXPIRY_SWEEP_BATCH)
+            if not rows:
+                break
+            results = await asyncio.gather(*[_expire_one(ch, tg_id, now) for tg_id, ch, _exp in rows])
+            if not all(results):
+                break
+            tg_id, ch, exp = rows[-1]
+            cursor = [exp, tg_id, ch]
+            await db_job_set("expiry_sweep", cursor)
+            done += len(rows)
+            if not await db_job_lease("expiry_sweep", JOB_LEASE_TTL):
+                log.warning("lease da expiração perdido no meio da varredura")
+                break
+    return done
+
+async def _remind_one(telegram_id: int, channel_id: int, expires_at: int):
+    # já renovou para depois desse vencimento => sem aviso
+    if await db_has_active_subscription(telegram_id, channel_id, expires_at):
+        return
+    exp = datetime.fromtimestamp(expires_at, timezone.utc)
+    channel = f" de *{catalog.channel_name(channel_id)}*" if len(catalog.channels) > 1 else ""
+    try:
         await bot.send_message(
             telegram_id,
-            "⚠️ Não consegui criar o link.\n"
-            "Verifique se o bot é ADMIN do canal e tem permissão de convidar usuários."
+            f"⏰ Sua assinatura{channel} vence em *{exp.astimezone().strftime('%d/%m/%Y %H:%M')}*.\n\n"
+            "Renove para não perder o acesso 👇",
+            parse_mode="Markdown",
+            reply_markup=kb_main()
         )
+    except (TelegramBadRequest, TelegramForbiddenError) as e:
+        log.info("lembrete não entregue a %s: %s", telegram_id, e)
+
+async def sweep_reminders() -> int:
+    """Avisa quem vence nos próximos REMINDER_DAYS dias (checkpoint próprio, lease como sweep_expired)."""
+    async with _remind_lock, job_lease("reminder_sweep") as leased:
+        if not leased:
+            event_scheduler.schedule(time.time() + JOB_LEASE_RETRY, "remind")
+            return 0
+        cursor = await db_job_get("reminder_sweep") or [0, 0, 0]
+        now = int(time.time())
+        # quem já venceu não recebe lembrete atrasado
+        if cursor[0] < now:
+            cursor = [now, 0, 0]
+        until = now + REMINDER_DAYS * 86400
+        done = 0
+
+        with priority(PRIORITY_BACKGROUND):
+            while True:
+                rows = await db_expiring_after(cursor, until, EXPIRY_SWEEP_BATCH)
+                if not rows:
+                    break
+                await asyncio.gather(*[_remind_one(tg_id, ch, exp) for tg_id, ch, exp in rows])
+                tg_id, ch, exp = rows[-1]
+                cursor = [exp, tg_id, ch]
+                await db_job_set("reminder_sweep", cursor)
+                done += len(rows)
+                if not await db_job_lease("reminder_sweep", JOB_LEASE_TTL):
+                    log.warning("lease dos lembretes perdido no meio da varredura")
+                    break
+        return done
+
+
+# =========================
+# Agendador de eventos (heap)
+# =========================
+class EventScheduler:
+    """
+    Min-heap de (quando, tipo): dispara cada evento no horário exato e
+    inserir é O(log n). Só guarda as próximas SCHEDULER_WINDOW expirações;
+    um evento "refill" recarrega a janela seguinte do DB quando ela chega.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.handlers = {}
+        self._heap = []
+        self._keys = set()
+        self._wakeup = asyncio.Event()
+        # último expires_at carregado; None = não há mais nada no DB além da janela
+        self.loaded_until: Optional[int] = 0
+        self.stats = {"fired": 0, "errors": 0}
+
+    def on(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def schedule(self, when: float, kind: str):
+        key = (int(when), kind)
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        heapq.heappush(self._heap, (when, kind))
+        if self._heap[0] == (when, kind):
+            self._wakeup.set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def reload(self):
+        """Recarrega a janela do zero (ex.: depois de import em massa)."""
+        self.loaded_until = 0
+        await self.load_window()
+
+    def add_expiry(self, expires_at: int):
+        self.schedule(expires_at, "expire")
+        remind_at = expires_at - REMINDER_DAYS * 86400
+        if remind_at > time.time():
+            self.schedule(remind_at, "remind")
+
+    def track_expiry(self, expires_at: int):
+        """Chamado ao aprovar: entra no heap se cair dentro da janela carregada."""
+        if self.loaded_until is None or expires_at <= self.loaded_until:
+            self.add_expiry(expires_at)
+
+    async def load_window(self):
+        after = self.loaded_until or int(time.time())
+        upcoming = await db_next_expirations(after, self.window)
+        for expires_at in upcoming:
+            self.add_expiry(expires_at)
+        if len(upcoming) < self.window:
+            self.loaded_until = None
+            return
+        self.loaded_until = upcoming[-1]
+        # recarrega a tempo de agendar também os lembretes da próxima janela
+        refill_at = self.loaded_until - REMINDER_DAYS * 86400
+        self.schedule(max(refill_at, time.time()), "refill")
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, kind = heapq.heappop(self._heap)
+            self._keys.discard((int(when), kind))
+            handler = self.handlers.get(kind)
+            if handler is not None:
+                self.stats["fired"] += 1
+                start_background(self._fire(kind, handler))
+
+    async def _fire(self, kind: str, handler):
+        try:
+            await handler()
+        except Exception:
+            self.stats["errors"] += 1
+            log.exception("falha no evento agendado %s", kind)
+
+
+event_scheduler = EventScheduler(SCHEDULER_WINDOW)
+event_scheduler.on("expire", sweep_expired)
+event_scheduler.on("remind", sweep_reminders)
+event_scheduler.on("refill", event_scheduler.load_window)
+
+async def cleanup_invite_links():
+    for pool in invite_pools.values():
+        if pool.evict_expired() or len(pool.links) <= pool.low:
+            pool.wake()
+
+event_scheduler.on("invite_cleanup", cleanup_invite_links)
 
 
 # =========================
 # FastAPI: webhook Kiwify
 # =========================
 @app.post("/kiwify/webhook")
+@timed(WEBHOOK_LATENCY)
 async def kiwify_webhook(request: Request):
     # Se você configurou um token no webhook da Kiwify, valide aqui:
     if KIWIFY_WEBHOOK_TOKEN:
@@ -440,46 +2647,582 @@ async def kiwify_webhook(request: Request):
     except Exception:
         return JSONResponse({"ok": True})
 
-    # Campos comuns (podem variar — mas isso já cobre o básico)
-    status = (data.get("status") or "").lower()
-    customer = data.get("customer") or {}
-    email = (customer.get("email") or "").strip().lower()
-
     # Aceita somente aprovado/paid
-    if status not in ("approved", "paid", "aprovado"):
+    if kiwify_status(data) not in ("approved", "paid", "aprovado"):
         return JSONResponse({"ok": True, "ignored": True})
 
-    if not email:
+    email = kiwify_email(data)
+    order_token = kiwify_order_token(data)
+    if not email and not order_token:
         return JSONResponse({"ok": True, "missing_email": True})
 
-    row = await db_get_latest_by_email(email)
+    # sem token e com email nunca cadastrado (compra feita fora do bot): responde sem DB
+    if known_emails is not None and not order_token:
+        if email not in known_emails:
+            EMAIL_FILTER_LOOKUPS.inc("rejected")
+            return JSONResponse({"ok": True, "user_not_found": True})
+        EMAIL_FILTER_LOOKUPS.inc("passed")
+
+    # grava o evento (durável) e responde já; os workers fazem o resto.
+    # Reentregas do mesmo pedido batem no índice único e não geram nada.
+    order_id = kiwify_order_id(data)
+    inbox_id = await db_inbox_add(order_id, data)
+    if inbox_id is None:
+        return JSONResponse({"ok": True, "duplicate": True})
+    webhook_queue.put_nowait((inbox_id, email, kiwify_product_id(data), order_token, order_id, 0))
+
+    return JSONResponse({"ok": True, "queued": True})
+
+
+# Campos comuns (podem variar — mas isso já cobre o básico)
+def kiwify_status(data: dict) -> str:
+    return (data.get("status") or data.get("order_status") or "").lower()
+
+def kiwify_email(data: dict) -> str:
+    customer = data.get("customer") or data.get("Customer") or {}
+    return (customer.get("email") or "").strip().lower()
+
+def kiwify_product_id(data: dict) -> Optional[str]:
+    product = data.get("Product") or data.get("product") or {}
+    product_id = product.get("product_id") or product.get("id") if isinstance(product, dict) else None
+    return str(product_id) if product_id else None
+
+def kiwify_order_token(data: dict) -> Optional[str]:
+    # volta do ?src= que o bot pôs no link de checkout
+    tracking = data.get("TrackingParameters") or data.get("tracking_parameters") or {}
+    token = tracking.get("src") if isinstance(tracking, dict) else None
+    return str(token).strip() if token else None
+
+def kiwify_order_id(data: dict) -> Optional[str]:
+    order_id = data.get("order_id") or data.get("id")
+    return str(order_id) if order_id else None
+
+
+webhook_queue: asyncio.Queue = asyncio.Queue()
+
+@timed(WEBHOOK_LATENCY)
+async def process_approved(
+    email: str,
+    kiwify_product: Optional[str] = None,
+    order_token: Optional[str] = None,
+    order_id: Optional[str] = None,
+) -> str:
+    # produto da Kiwify -> plano do catálogo (dict); sem ele, vale o plano do pedido
+    product = catalog.by_kiwify.get(kiwify_product) if kiwify_product else None
+    row = None
+    # pedido pelo token do link (índice único); email só para links antigos/sem src
+    if order_token:
+        row = await db_get_by_order_token(order_token)
+        if row is None:
+            # pedido apagado pela compactação ou token forjado: tenta pelo email
+            KIWIFY_UNKNOWN_TOKENS.inc()
+            log.warning("token de pedido %r (Kiwify %s, %s) não casou com nenhum pedido", order_token, order_id, email)
+    if row is None and email and product is not None:
+        row = await db_get_latest_by_email(email, product.code)
+    if row is None and email:
+        row = await db_get_latest_by_email(email)
     if not row:
-        return JSONResponse({"ok": True, "user_not_found": True})
+        return "user_not_found"
 
     row_id, telegram_id, _email, old_status, created_at, approved_at, expires_at, plan = row
+    if product is None:
+        product = catalog.products.get(plan)
+        if product is None:
+            log.warning("pedido %s com plano %r fora do catálogo", row_id, plan)
+            return "unknown_product"
+
+    # pedido já aprovado: só credita de novo se for outro pedido da Kiwify
+    credited = await db_mark_approved(row_id, product, telegram_id, email, order_id)
+    if credited and known_emails is not None and email:
+        known_emails.add(email)
+    if not credited and order_id is None:
+        log.warning("pagamento sem order_id para o pedido %s já aprovado: nada creditado", row_id)
+
+    # libera acesso. O crédito já foi gravado: usuário que bloqueou o bot (ou chat
+    # inválido) não adianta tentar de novo
+    try:
+        await grant_access(int(telegram_id), product.channel_id)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        log.warning("acesso de %s creditado, mas a mensagem não foi entregue: %s", telegram_id, e)
+        return "granted_undeliverable"
+    return "granted"
+
+async def replay_inbox():
+    """
+    Recoloca na fila eventos não processados sem dono: recebidos antes de um
+    crash/restart ou reivindicados por uma réplica que caiu (prazo vencido).
+    Os que outra instância viva está processando ficam com ela.
+    """
+    rows = await db_inbox_claim()
+    for inbox_id, payload in rows:
+        data = json.loads(payload)
+        webhook_queue.put_nowait(
+            (inbox_id, kiwify_email(data), kiwify_product_id(data), kiwify_order_token(data), kiwify_order_id(data), 0)
+        )
+    if rows:
+        log.info("reprocessando %d eventos pendentes do inbox", len(rows))
+
+webhook_retries = {"scheduled": 0, "waiting": 0, "failed": 0}
+
+def retry_webhook_later(item: tuple, delay: float):
+    webhook_retries["scheduled"] += 1
+    webhook_retries["waiting"] += 1
+
+    def requeue():
+        webhook_retries["waiting"] -= 1
+        webhook_queue.put_nowait(item)
+
+    asyncio.get_running_loop().call_later(delay, requeue)
+
+async def webhook_worker():
+    while True:
+        item = await webhook_queue.get()
+        inbox_id, email, kiwify_product, order_token, order_id, attempt = item
+        try:
+            result = await process_approved(email, kiwify_product, order_token, order_id)
+            await db_inbox_done(inbox_id, result)
+        except Exception:
+            attempt += 1
+            if attempt >= WEBHOOK_MAX_ATTEMPTS:
+                log.exception("webhook %s desistido depois de %d tentativas", inbox_id, attempt)
+                webhook_retries["failed"] += 1
+                try:
+                    await db_inbox_done(inbox_id, "failed")
+                except Exception:
+                    # sem processed_at: replay_inbox tenta de novo no próximo start
+                    log.exception("falha marcando webhook %s como failed", inbox_id)
+                continue
+            # continua sem processed_at no inbox; tenta de novo com backoff (DB
+            # travado/Telegram fora do ar), mantendo o claim para outra réplica não pegar
+            delay = min(WEBHOOK_RETRY_BASE * 2 ** (attempt - 1), WEBHOOK_RETRY_MAX)
+            log.exception("falha processando webhook %s (tentativa %d); nova tentativa em %.0fs",
+                          inbox_id, attempt, delay)
+            try:
+                await db_inbox_extend_claim(inbox_id, int(time.time() + delay) + WEBHOOK_CLAIM_TTL)
+            except Exception:
+                log.exception("falha renovando o claim do webhook %s", inbox_id)
+            retry_webhook_later(item[:-1] + (attempt,), delay)
+        finally:
+            webhook_queue.task_done()
+
+
+# =========================
+# FastAPI: webhook Telegram
+# =========================
+update_tasks = set()
 
-    # só marca aprovado se ainda não estava
-    if old_status != "approved":
-        await db_mark_approved(row_id, plan)
+@app.post(TELEGRAM_WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if TELEGRAM_MODE != "webhook":
+        return JSONResponse({"ok": False, "error": "webhook_disabled"}, status_code=404)
 
-    # libera acesso
-    await grant_access(int(telegram_id))
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+    if not hmac.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+        return JSONResponse({"ok": False, "error": "invalid_token"}, status_code=401)
 
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception:
+        return JSONResponse({"ok": False, "error": "invalid_update"}, status_code=400)
+
+    # responde já; o Telegram reenvia se demorarmos
+    task = asyncio.create_task(dp.feed_update(bot, update))
+    update_tasks.add(task)
+    task.add_done_callback(update_tasks.discard)
     return JSONResponse({"ok": True})
 
+async def setup_telegram_webhook():
+    url = TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH
+    allowed = dp.resolve_used_update_types()
+    # o getWebhookInfo não devolve o segredo: guarda um hash dele para notar a troca
+    secret_hash = hashlib.sha256(TELEGRAM_WEBHOOK_SECRET.encode()).hexdigest()
+    # todas as réplicas sobem com o mesmo valor; só chama setWebhook se mudou
+    info = await bot.get_webhook_info()
+    if (
+        info.url == url
+        and sorted(info.allowed_updates or []) == sorted(allowed)
+        and await db_job_get("telegram_webhook_secret") == secret_hash
+    ):
+        return
+    await bot.set_webhook(
+        url,
+        secret_token=TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=allowed,
+    )
+    await db_job_set("telegram_webhook_secret", secret_hash)
+    log.info("webhook do Telegram configurado em %s", url)
+
 
 # =========================
-# Healthcheck
+# Admin: export/import (CSV / NDJSON)
+# =========================
+EXPORT_TABLES = {
+    "payments": [
+        "id", "telegram_id", "email", "status", "created_at", "approved_at", "expires_at", "plan", "order_token",
+        "kiwify_order_id",
+    ],
+    "subscriptions": ["telegram_id", "channel_id", "plan", "expires_at", "payment_id", "updated_at"],
+    "channels": ["id", "name", "active"],
+    "products": [
+        "code", "channel_id", "label", "price", "duration_days",
+        "checkout_url", "kiwify_product_id", "position", "active",
+    ],
+}
+EXPORT_FORMATS = ("csv", "ndjson")
+
+def _csv_line(values) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerow(["" if v is None else v for v in values])
+    return buf.getvalue()
+
+async def export_rows(table: str, fmt: str):
+    """Gera o dump em pedaços de EXPORT_CHUNK linhas (memória constante)."""
+    columns = EXPORT_TABLES[table]
+    if fmt == "csv":
+        yield _csv_line(columns)
+    async with db_pool.dedicated() as db:
+        cur = await db.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {columns[0]}")
+        while True:
+            rows = await cur.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            if fmt == "csv":
+                yield "".join(_csv_line(r) for r in rows)
+            else:
+                yield "".join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows)
+        await cur.close()
+
+async def _text_lines(chunks):
+    """Linhas do corpo (com o \n do fim), decodificadas aos poucos."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    rest = ""
+    async for chunk in chunks:
+        rest += decoder.decode(chunk)
+        *lines, rest = rest.split("\n")
+        for line in lines:
+            yield line + "\n"
+    rest += decoder.decode(b"", final=True)
+    if rest:
+        yield rest
+
+class _LineFeed:
+    """Iterador que o csv.reader consome; as linhas chegam depois, do stream."""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def import_rows(table: str, fmt: str, chunks) -> int:
+    """
+    Carrega linhas (INSERT OR REPLACE) em transações de IMPORT_BATCH linhas.
+    CSV: primeira linha é o cabeçalho; campo vazio vira NULL.
+    """
+    global known_emails
+    allowed = EXPORT_TABLES[table]
+    columns = None
+    batch = []
+    total = 0
+    # um reader só para o arquivo todo: campo entre aspas pode ter quebra de linha
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    quotes = 0
+
+    async def flush():
+        nonlocal total
+        if not batch:
+            return
+        async with db_pool.write() as db:
+            await db.executemany(
+                f"INSERT OR REPLACE INTO {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                batch
+            )
+        total += len(batch)
+        batch.clear()
+
+    async for line in _text_lines(chunks):
+        if fmt == "csv":
+            feed.lines.append(line)
+            # aspas ímpares = registro continua na próxima linha
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            quotes = 0
+            try:
+                values = next(reader, None)
+            except csv.Error as e:
+                raise ValueError(f"CSV inválido: {e}")
+            if not values:
+                continue
+            if columns is None:
+                columns = values
+                _check_columns(columns, allowed)
+                continue
+            batch.append([v if v != "" else None for v in values])
+        else:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if columns is None:
+                columns = list(obj)
+                _check_columns(columns, allowed)
+            batch.append([obj.get(c) for c in columns])
+        if len(batch) >= IMPORT_BATCH:
+            await flush()
+    if quotes % 2:
+        raise ValueError("CSV inválido: aspas sem fechar no fim do arquivo")
+    await flush()
+
+    # dados mudaram por fora dos helpers: zera caches derivados
+    sub_cache.clear()
+    if known_emails is not None and table == "payments":
+        known_emails = await db_load_known_emails()
+    if table == "subscriptions":
+        await event_scheduler.reload()
+    if table in ("channels", "products"):
+        await catalog_reload()
+    return total
+
+def _check_columns(columns, allowed):
+    unknown = [c for c in columns if c not in allowed]
+    if unknown:
+        raise ValueError(f"colunas desconhecidas: {', '.join(unknown)}")
+
+def _admin_denied(request: Request) -> Optional[JSONResponse]:
+    if not ADMIN_TOKEN:
+        return JSONResponse({"ok": False, "error": "admin_disabled"}, status_code=404)
+    token = request.headers.get("X-Admin-Token") or ""
+    if not hmac.compare_digest(token.strip(), ADMIN_TOKEN):
+        return JSONResponse({"ok": False, "error": "invalid_token"}, status_code=401)
+    return None
+
+@app.get("/admin/export/{table}")
+async def admin_export(table: str, request: Request, format: str = "ndjson"):
+    denied = _admin_denied(request)
+    if denied:
+        return denied
+    if table not in EXPORT_TABLES or format not in EXPORT_FORMATS:
+        return JSONResponse({"ok": False, "error": "invalid_table_or_format"}, status_code=400)
+    media = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_rows(table, format),
+        media_type=media,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+@app.post("/admin/import/{table}")
+async def admin_import(table: str, request: Request, format: str = "ndjson"):
+    denied = _admin_denied(request)
+    if denied:
+        return denied
+    if table not in EXPORT_TABLES or format not in EXPORT_FORMATS:
+        return JSONResponse({"ok": False, "error": "invalid_table_or_format"}, status_code=400)
+    try:
+        total = await import_rows(table, format, request.stream())
+    except (ValueError, sqlite3.Error) as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    return JSONResponse({"ok": True, "imported": total})
+
+
+# =========================
+# Healthcheck / métricas
 # =========================
 @app.get("/")
 async def root():
     return {"ok": True, "service": "telegram-vip-bot"}
 
+@app.get("/stats")
+async def stats():
+    return {
+        "sub_cache": {**sub_cache.stats, "size": len(sub_cache)},
+        "send_queue": {**send_scheduler.stats, "depth": send_scheduler.queue_depth()},
+        "db_pending_writes": db_pool.pending_writes(),
+        "webhook_queue": webhook_queue.qsize(),
+        "webhook_retries": dict(webhook_retries),
+        "catalog_version": catalog.version,
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _cache_hit_ratio() -> float:
+    lookups = sub_cache.stats["hits"] + sub_cache.stats["misses"]
+    return sub_cache.stats["hits"] / lookups if lookups else 0.0
+
+
+CollectedMetric("vip_send_queue_depth", "Envios aguardando a fila do Telegram", "gauge", ("priority",),
+                lambda: {(p,): n for p, n in send_scheduler.queue_depth_by_priority().items()})
+CollectedMetric("vip_send_events_total", "Resultados da fila de envio", "counter", ("event",),
+                lambda: {(k,): v for k, v in send_scheduler.stats.items() if k != "queued_max"})
+CollectedMetric("vip_webhook_queue_depth", "Eventos Kiwify aguardando os workers", "gauge", (),
+                lambda: webhook_queue.qsize())
+CollectedMetric("vip_webhook_retry_waiting", "Eventos Kiwify que falharam, esperando nova tentativa", "gauge", (),
+                lambda: webhook_retries["waiting"])
+CollectedMetric("vip_webhook_failed_total", "Eventos Kiwify desistidos depois de WEBHOOK_MAX_ATTEMPTS", "counter", (),
+                lambda: webhook_retries["failed"])
+CollectedMetric("vip_db_pending_writes", "Escritas aguardando o lote do write-behind", "gauge", (),
+                lambda: db_pool.pending_writes())
+CollectedMetric("vip_updates_in_flight", "Updates do Telegram (webhook) em processamento", "gauge", (),
+                lambda: len(update_tasks))
+CollectedMetric("vip_sub_cache_events_total", "Eventos do cache de assinaturas", "counter", ("event",),
+                lambda: {(k,): v for k, v in sub_cache.stats.items()})
+CollectedMetric("vip_sub_cache_hit_ratio", "Taxa de acerto do cache de assinaturas", "gauge", (),
+                _cache_hit_ratio)
+CollectedMetric("vip_sub_cache_size", "Entradas no cache de assinaturas", "gauge", (),
+                lambda: len(sub_cache))
+
+
+# =========================
+# Jobs em background
+# =========================
+background_tasks = set()
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def compaction_loop():
+    while True:
+        try:
+            removed = await db_compact_pending(PENDING_RETENTION_DAYS)
+            if removed:
+                log.info("compactação: %d pedidos pendentes antigos removidos", removed)
+            if FSM_STORAGE == "sqlite":
+                await db_fsm_evict(FSM_STATE_TTL)
+        except Exception:
+            log.exception("falha na compactação (pedidos pendentes / FSM)")
+        await asyncio.sleep(PENDING_COMPACT_INTERVAL)
+
+
+async def catalog_watch_loop():
+    # trigger no DB sobe catalog_version; aqui cada instância só lê 1 inteiro
+    while True:
+        await asyncio.sleep(CATALOG_POLL_INTERVAL)
+        try:
+            if await db_catalog_version() != catalog.version:
+                await catalog_reload()
+                start_invite_pools()
+                log.info("catálogo recarregado (versão %d)", catalog.version)
+        except Exception:
+            log.exception("falha recarregando o catálogo")
+
+
+async def inbox_replay_loop():
+    # eventos de réplicas que caíram (claim vencido) sem esperar um restart
+    while True:
+        await asyncio.sleep(INBOX_REPLAY_INTERVAL)
+        try:
+            await replay_inbox()
+        except Exception:
+            log.exception("falha reprocessando o inbox")
+
+async def expiry_sweep_loop():
+    while True:
+        try:
+            removed = await sweep_expired()
+            if removed:
+                log.info("expiração: %d assinaturas vencidas processadas", removed)
+            await sweep_reminders()
+        except Exception:
+            log.exception("falha no job de expiração")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
 
 # =========================
 # Startup
 # =========================
 @app.on_event("startup")
 async def on_startup():
+    global known_emails
+    await db_pool.open()
     await db_init()
-    asyncio.create_task(dp.start_polling(bot))
+    await db_check_query_plans()
+    await db_seed_catalog()
+    await catalog_reload()
+    if EMAIL_FILTER:
+        known_emails = await db_load_known_emails()
+    start_background(compaction_loop())
+    start_background(expiry_sweep_loop())
+    start_background(catalog_watch_loop())
+    await event_scheduler.load_window()
+    start_background(event_scheduler.run())
+    await replay_inbox()
+    start_background(inbox_replay_loop())
+    start_invite_pools()
+    for _ in range(max(WEBHOOK_WORKERS, 1)):
+        start_background(webhook_worker())
+
+    if TELEGRAM_MODE == "webhook":
+        await setup_telegram_webhook()
+    else:
+        # webhook de um deploy anterior faz todo getUpdates dar 409 Conflict
+        info = await bot.get_webhook_info()
+        if info.url:
+            await bot.delete_webhook()
+            log.info("webhook do Telegram (%s) removido para usar polling", info.url)
+        start_background(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # termina updates em andamento antes de derrubar DB/sessão
+    if update_tasks:
+        await asyncio.wait(update_tasks, timeout=10)
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    for pool in invite_pools.values():
+        await pool.close()
+    await db_pool.close()
+    await bot.session.close()
+
+
+# =========================
+# CLI (export/import)
+# =========================
+def cli(argv=None) -> int:
+    """
+    python main.py export payments --format csv > payments.csv
+    python main.py import subscriptions --format ndjson < subs.ndjson
+    """
+    parser = argparse.ArgumentParser(prog="main.py")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    args = parser.parse_args(argv)
+
+    async def stdin_chunks():
+        while True:
+            chunk = sys.stdin.buffer.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+    async def run():
+        await db_pool.open()
+        try:
+            await db_init()
+            if args.command == "export":
+                async for part in export_rows(args.table, args.format):
+                    sys.stdout.write(part)
+            else:
+                total = await import_rows(args.table, args.format, stdin_chunks())
+                print(f"{total} linhas importadas em {args.table}", file=sys.stderr)
+        finally:
+            await db_pool.close()
+
+    asyncio.run(run())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
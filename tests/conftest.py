@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main.py lê a configuração do ambiente no import
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-token")
+os.environ.setdefault("CHANNEL_ID", "-100123")
+os.environ.setdefault("TELEGRAM_MODE", "polling")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
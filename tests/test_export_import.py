@@ -0,0 +1,81 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+LABEL = 'Plano "mês"\nlinha 2, com vírgula ção'
+CHANNEL_NAME = "Canal\r\nVIP 🚀"
+
+
+async def open_catalog(monkeypatch, tmp_path):
+    pool = main.DBPool(str(tmp_path / "db.sqlite3"), 1)
+    monkeypatch.setattr(main, "db_pool", pool)
+    await pool.open()
+    await main.db_init()
+    await main.db_seed_catalog()
+    async with pool.write() as db:
+        await db.execute("UPDATE products SET label=? WHERE code='30d'", (LABEL,))
+        await db.execute("UPDATE channels SET name=?", (CHANNEL_NAME,))
+    return pool
+
+
+async def table_rows(pool, table):
+    async with pool.read() as db:
+        cur = await db.execute(f"SELECT * FROM {table} ORDER BY 1")
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+
+def chunked(data: bytes, size: int = 3):
+    # pedaços pequenos: cortam linhas, campos entre aspas e caracteres multibyte
+    async def chunks():
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+    return chunks()
+
+
+@pytest.mark.parametrize("table", ["products", "channels"])
+@pytest.mark.parametrize("fmt", ["csv", "ndjson"])
+def test_export_import_round_trip(monkeypatch, tmp_path, table, fmt):
+    async def run():
+        pool = await open_catalog(monkeypatch, tmp_path)
+        try:
+            before = await table_rows(pool, table)
+            dump = "".join([part async for part in main.export_rows(table, fmt)]).encode()
+            async with pool.write() as db:
+                await db.execute(f"DELETE FROM {table}")
+
+            imported = await main.import_rows(table, fmt, chunked(dump))
+
+            assert imported == len(before)
+            assert await table_rows(pool, table) == before
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_csv_unclosed_quote_is_rejected(monkeypatch, tmp_path):
+    body = b'code,label\n30d,"aberto\n'
+
+    async def run():
+        pool = await open_catalog(monkeypatch, tmp_path)
+        try:
+            with pytest.raises(ValueError, match="aspas"):
+                await main.import_rows("products", "csv", chunked(body))
+
+            monkeypatch.setattr(main, "ADMIN_TOKEN", "admin")
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                r = await client.post(
+                    "/admin/import/products?format=csv", content=body, headers={"X-Admin-Token": "admin"}
+                )
+            assert r.status_code == 400
+            assert r.json()["ok"] is False
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,87 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import main
+
+# schema e ALTERs do db_init original (antes das migrações versionadas)
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payments (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  telegram_id INTEGER NOT NULL,
+  email TEXT,
+  status TEXT NOT NULL,
+  created_at TEXT NOT NULL,
+  approved_at TEXT,
+  expires_at TEXT,
+  plan TEXT NOT NULL
+);
+"""
+
+
+def make_baseline_db(path, rows):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO payments(telegram_id, email, status, created_at, approved_at, expires_at, plan) "
+        "VALUES (?,?,?,?,?,?,?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def migrate(path, monkeypatch):
+    async def run():
+        pool = main.DBPool(str(path), 1)
+        monkeypatch.setattr(main, "db_pool", pool)
+        await pool.open()
+        try:
+            await main.db_init()
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            "version": conn.execute("PRAGMA user_version").fetchone()[0],
+            "subscriptions": {
+                r[0]: r[1:]
+                for r in conn.execute("SELECT telegram_id, channel_id, plan, expires_at FROM subscriptions")
+            },
+        }
+    finally:
+        conn.close()
+
+
+def test_baseline_db_migrates_subscriptions(tmp_path, monkeypatch, caplog):
+    now = datetime.now(timezone.utc)
+    iso = now.isoformat()
+    expires = now + timedelta(days=10)
+    path = tmp_path / "baseline.sqlite3"
+    make_baseline_db(path, [
+        (1, "a@x.com", "approved", iso, iso, expires.isoformat(), "30d"),
+        (2, "b@x.com", "approved", iso, iso, None, "30d"),            # sem data: não vira vitalícia
+        (3, "c@x.com", "approved", iso, iso, None, "life"),
+        (4, "d@x.com", "approved", iso, iso, "amanhã", "30d"),         # data que não parseia
+        (5, "e@x.com", "pending", iso, None, None, "30d"),
+    ])
+
+    result = migrate(path, monkeypatch)
+
+    assert result["version"] == len(main.MIGRATIONS)
+    channel = int(main.CHANNEL_ID)
+    assert result["subscriptions"] == {
+        1: (channel, "30d", int(expires.timestamp())),
+        3: (channel, "life", None),
+    }
+    assert "telegram_id=2" in caplog.text
+    assert "telegram_id=4" in caplog.text
+
+
+def test_db_init_is_idempotent(tmp_path, monkeypatch):
+    path = tmp_path / "fresh.sqlite3"
+    first = migrate(path, monkeypatch)
+    second = migrate(path, monkeypatch)
+    assert first == second == {"version": len(main.MIGRATIONS), "subscriptions": {}}
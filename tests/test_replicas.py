@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+import main
+
+
+async def open_db(monkeypatch, tmp_path):
+    pool = main.DBPool(str(tmp_path / "db.sqlite3"), 1)
+    monkeypatch.setattr(main, "db_pool", pool)
+    await pool.open()
+    await main.db_init()
+    return pool
+
+
+def test_job_lease_is_exclusive(monkeypatch, tmp_path):
+    async def run():
+        pool = await open_db(monkeypatch, tmp_path)
+        try:
+            monkeypatch.setattr(main, "INSTANCE_ID", "a")
+            assert await main.db_job_lease("expiry_sweep", 60)
+            assert await main.db_job_lease("expiry_sweep", 60)  # renovar o próprio lease
+
+            monkeypatch.setattr(main, "INSTANCE_ID", "b")
+            async with main.job_lease("expiry_sweep") as leased:
+                assert not leased
+
+            monkeypatch.setattr(main, "INSTANCE_ID", "a")
+            await main.db_job_release("expiry_sweep")
+            monkeypatch.setattr(main, "INSTANCE_ID", "b")
+            async with main.job_lease("expiry_sweep") as leased:
+                assert leased
+            # prazo vencido vale como livre
+            await main.db_job_lease("expiry_sweep", -1)
+            monkeypatch.setattr(main, "INSTANCE_ID", "a")
+            assert await main.db_job_lease("expiry_sweep", 60)
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_inbox_claim_skips_events_of_live_instances(monkeypatch, tmp_path):
+    async def run():
+        pool = await open_db(monkeypatch, tmp_path)
+        try:
+            monkeypatch.setattr(main, "INSTANCE_ID", "a")
+            mine = await main.db_inbox_add("K1", {"order_id": "K1"})
+            # evento de uma réplica que caiu: claim vencido
+            dead = await main.db_inbox_add("K2", {"order_id": "K2"})
+            await pool.enqueue("UPDATE webhook_inbox SET claimed_by='x', claimed_until=0 WHERE id=?", (dead,))
+
+            monkeypatch.setattr(main, "INSTANCE_ID", "b")
+            claimed = await main.db_inbox_claim()
+            assert [(row_id, json.loads(payload)["order_id"]) for row_id, payload in claimed] == [(dead, "K2")]
+            # já reivindicado por b: ninguém pega de novo
+            assert await main.db_inbox_claim() == []
+            assert mine is not None
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
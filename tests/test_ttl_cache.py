@@ -0,0 +1,45 @@
+import main
+
+
+def test_invalidate_drops_only_that_keys_fill():
+    cache = main.TTLCache(10, 30)
+    generation = cache.generation()
+    cache.invalidate("a")
+    cache.set("a", 1, generation)
+    cache.set("b", 2, generation)
+    assert cache.get("a") == (False, None)
+    assert cache.get("b") == (True, 2)
+
+
+def test_fill_started_after_invalidate_is_kept():
+    cache = main.TTLCache(10, 30)
+    cache.invalidate("a")
+    generation = cache.generation()
+    cache.set("a", 1, generation)
+    assert cache.get("a") == (True, 1)
+
+
+def test_clear_drops_every_fill_in_flight():
+    cache = main.TTLCache(10, 30)
+    generation = cache.generation()
+    cache.clear()
+    cache.set("a", 1, generation)
+    assert cache.get("a") == (False, None)
+    cache.set("a", 2, cache.generation())
+    assert cache.get("a") == (True, 2)
+
+
+def test_pruned_invalidations_raise_the_floor():
+    cache = main.TTLCache(2, 30)
+    generation = cache.generation()
+    for key in ("a", "b", "c"):
+        cache.invalidate(key)
+    # "a" saiu da lista de invalidados, mas o floor ainda barra o valor velho
+    assert "a" not in cache._invalidated
+    assert len(cache._invalidated) == 2
+    cache.set("a", 1, generation)
+    cache.set("z", 1, generation)  # conservador: qualquer fill anterior ao floor
+    assert cache.get("a") == (False, None)
+    assert cache.get("z") == (False, None)
+    cache.set("a", 2, cache.generation())
+    assert cache.get("a") == (True, 2)
@@ -0,0 +1,71 @@
+import asyncio
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+import main
+
+
+async def inbox_result(pool, inbox_id):
+    async with pool.read() as db:
+        cur = await db.execute("SELECT result FROM webhook_inbox WHERE id=?", (inbox_id,))
+        (result,) = await cur.fetchone()
+        await cur.close()
+    return result
+
+
+async def run_worker(monkeypatch, tmp_path, grant):
+    pool = main.DBPool(str(tmp_path / "db.sqlite3"), 1)
+    monkeypatch.setattr(main, "db_pool", pool)
+    monkeypatch.setattr(main, "webhook_queue", asyncio.Queue())
+    monkeypatch.setattr(main, "grant_access", grant)
+    monkeypatch.setattr(main, "WEBHOOK_RETRY_BASE", 0.001)
+    monkeypatch.setattr(main, "WEBHOOK_MAX_ATTEMPTS", 3)
+    main.sub_cache.clear()
+    await pool.open()
+    try:
+        await main.db_init()
+        await main.db_seed_catalog()
+        await main.catalog_reload()
+        token = await main.db_create_pending(42, "30d")
+        inbox_id = await main.db_inbox_add("K1", {})
+        main.webhook_queue.put_nowait((inbox_id, "a@x.com", None, token, "K1", 0))
+
+        worker = asyncio.create_task(main.webhook_worker())
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if await inbox_result(pool, inbox_id) is not None:
+                break
+        worker.cancel()
+        result = await inbox_result(pool, inbox_id)
+        subs, _latest = await main.db_get_subscription_status(42)
+        return result, subs
+    finally:
+        await pool.close()
+
+
+def test_blocked_user_is_final(monkeypatch, tmp_path):
+    calls = []
+
+    async def grant(telegram_id, channel_id):
+        calls.append(telegram_id)
+        raise TelegramForbiddenError(SendMessage(chat_id=telegram_id, text="x"), "bot was blocked by the user")
+
+    result, subs = asyncio.run(run_worker(monkeypatch, tmp_path, grant))
+    assert result == "granted_undeliverable"
+    assert len(calls) == 1
+    assert [plan for _ch, plan, _exp in subs] == ["30d"]
+
+
+def test_retries_stop_at_max_attempts(monkeypatch, tmp_path):
+    calls = []
+
+    async def grant(telegram_id, channel_id):
+        calls.append(telegram_id)
+        raise RuntimeError("telegram fora do ar")
+
+    result, subs = asyncio.run(run_worker(monkeypatch, tmp_path, grant))
+    assert result == "failed"
+    assert len(calls) == 3
+    # o crédito da primeira tentativa não se repete nas outras
+    assert len(subs) == 1